@@ -1,19 +1,84 @@
-from flask import Flask, request, jsonify, send_from_directory
+import hashlib
+import json
+import os
+import queue
+import time
+from multiprocessing import AuthenticationError
+from flask import Flask, Response, request, jsonify, send_file
 from flasgger import Swagger
+from werkzeug.http import parse_content_range_header
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_cors import CORS
-from services.classification import ClassificationService, celery, classification_task
+from services.classification import (
+    CLASSIFICATION_TYPES,
+    celery,
+    classification_task,
+    progress_events,
+    queue_depths,
+    sharded_progress,
+)
+from services.file_service import FileService
+from services.inference_server import InferenceClient, LatencyStats, parse_address
+from services.job_queues import JOB_CLASSES, percentile, queue_name
+from services.output_formats import FORMATS as OUTPUT_FORMATS, available_formats
+from services.prediction_cache import PredictionCache
+from services.storage_manager import StorageManager
+from utils import metrics
 from utils.config import Config
 
 app = Flask(__name__)
+if Config.TRUSTED_PROXY_HOPS:
+    # remote_addr becomes the address the last trusted proxy saw; anything a
+    # client puts in X-Forwarded-For in front of that is ignored
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.TRUSTED_PROXY_HOPS)
 swagger = Swagger(app)
 # enable cors
 CORS(app)
 app.config["MAX_CONTENT_LENGTH"] = Config.MAX_CONTENT_LENGTH
 app.debug = Config.DEBUG
 
-# init service
-classification_service = ClassificationService()
-file_service = classification_service.file_service
+# init service; the api process only handles files, models live in the workers
+file_service = FileService(
+    Config.UPLOAD_FOLDER, Config.OUTPUT_FOLDER, status_cache_ttl=Config.STATUS_CACHE_TTL
+)
+prediction_cache = PredictionCache(
+    Config.PREDICTION_CACHE_DB, Config.PREDICTION_CACHE_MAX_ENTRIES
+)
+# small synchronous requests go to the inference server instead of celery
+inference_client = InferenceClient(
+    parse_address(Config.INFERENCE_SERVER_ADDRESS), Config.INFERENCE_SERVER_AUTHKEY.encode()
+)
+classify_latency = LatencyStats()
+storage_manager = StorageManager(
+    file_service,
+    Config.STORAGE_QUOTA_BYTES,
+    low_watermark=Config.STORAGE_LOW_WATERMARK,
+    min_age=Config.STORAGE_MIN_AGE,
+)
+
+
+def client_id():
+    """Who is uploading, for the per-client limit on large jobs. Behind
+    TRUSTED_PROXY_HOPS reverse proxies, the address they report (see ProxyFix)."""
+    return request.remote_addr
+
+
+def enqueue_classification(unique_id, classification_types, profile=False):
+    """Queue a new upload's task on the queue of its cost class."""
+    job_class = file_service.assign_job(unique_id, client_id())
+    return classification_task.apply_async(
+        args=[unique_id, classification_types, profile],
+        task_id=unique_id,
+        queue=queue_name(job_class),
+    )
+
+
+def parse_classification_types(types):
+    """The requested types, or None if any of them is not available."""
+    available = CLASSIFICATION_TYPES if Config.THEME_HEADS_PATH else ("sentiment",)
+    if not types or any(t not in available for t in types):
+        return None
+    return types
 
 
 @app.route("/api/upload", methods=["POST"])
@@ -29,6 +94,23 @@ def upload_file():
         type: file
         required: true
         description: The CSV file to upload. Must contain a 'comment' column.
+      - name: classification_types
+        in: formData
+        type: string
+        required: false
+        default: sentiment
+        description: >
+          Comma separated types to predict: sentiment, main_theme, sub_theme.
+          The theme types need THEME_HEADS_PATH. All types share one encoder pass.
+      - name: profile
+        in: formData
+        type: boolean
+        required: false
+        default: false
+        description: >
+          Run the classification under the profiler; the result is served by
+          /api/profile/{task_id}. Files already classified with the same
+          model and types are not classified again, so they are not profiled.
     responses:
       202:
         description: File uploaded successfully and processing task queued
@@ -54,11 +136,17 @@ def upload_file():
         return jsonify({"error": "No selected file"}), 400
     if not file.filename.lower().endswith(".csv"):
         return jsonify({"error": "File must be a CSV"}), 400
+    classification_types = parse_classification_types(
+        [t.strip() for t in request.form.get("classification_types", "sentiment").split(",") if t.strip()]
+    )
+    if not classification_types:
+        return jsonify({"error": "Unknown or unavailable classification_types"}), 400
+    profile = request.form.get("profile", "false").lower() in ("1", "true", "yes")
 
     try:
-        unique_id, old_id = file_service.save_uploaded_file(file)
+        unique_id, old_id = file_service.save_uploaded_file(file, classification_types)
         if not old_id:
-            task = classification_task.apply_async(args=[unique_id], task_id=unique_id)
+            task = enqueue_classification(unique_id, classification_types, profile)
         return jsonify({"task_id": unique_id}), 202
     except Exception as e:
         app.logger.error(f"error: {str(e)}")
@@ -68,6 +156,275 @@ def upload_file():
             return jsonify({"error": "Internal server error."}), 400
 
 
+@app.route("/api/upload/init", methods=["POST"])
+def init_upload():
+    """
+    Start a hash-first, resumable upload
+    ---
+    tags:
+      - Upload
+    consumes:
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - filename
+            - sha256
+            - size
+          properties:
+            filename:
+              type: string
+            sha256:
+              type: string
+              description: Hex SHA-256 of the whole file
+            size:
+              type: integer
+              description: File size in bytes
+            classification_types:
+              type: array
+              items:
+                type: string
+              default: [sentiment]
+    responses:
+      200:
+        description: >
+          The server already has this file; no upload is needed and task_id
+          points at its result, which is reused if it was already classified
+          with the same model and types
+        schema:
+          type: object
+          properties:
+            task_id:
+              type: string
+      201:
+        description: >
+          Unknown file. PUT its bytes in chunks of at most chunk_size to
+          upload_url, each with a Content-Range header
+        schema:
+          type: object
+          properties:
+            upload_id:
+              type: string
+            upload_url:
+              type: string
+            chunk_size:
+              type: integer
+            received:
+              type: integer
+      400:
+        description: Invalid request body
+    """
+    body = request.get_json(silent=True) or {}
+    filename = body.get("filename") or ""
+    hash_value = str(body.get("sha256") or "").lower()
+    size = body.get("size")
+    if not filename.lower().endswith(".csv"):
+        return jsonify({"error": "File must be a CSV"}), 400
+    if len(hash_value) != 64 or any(c not in "0123456789abcdef" for c in hash_value):
+        return jsonify({"error": "sha256 must be a hex SHA-256 digest"}), 400
+    if not isinstance(size, int) or not 0 < size <= Config.MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"size must be between 1 and {Config.MAX_UPLOAD_BYTES}"}), 400
+    classification_types = parse_classification_types(body.get("classification_types", ["sentiment"]))
+    if not classification_types:
+        return jsonify({"error": "Unknown or unavailable classification_types"}), 400
+
+    known = file_service.register_known_upload(filename, hash_value, size, classification_types)
+    if known:
+        unique_id, old_id = known
+        if not old_id:
+            enqueue_classification(unique_id, classification_types)
+        return jsonify({"task_id": unique_id}), 200
+    file_service.expire_upload_sessions(Config.UPLOAD_SESSION_TTL)
+    upload_id = file_service.create_upload_session(filename, hash_value, size, classification_types)
+    return jsonify(
+        {
+            "upload_id": upload_id,
+            "upload_url": f"/api/upload/{upload_id}",
+            "chunk_size": Config.UPLOAD_CHUNK_SIZE,
+            "received": 0,
+        }
+    ), 201
+
+
+@app.route("/api/upload/<upload_id>", methods=["GET"])
+def get_upload(upload_id):
+    """
+    Get the progress of a resumable upload
+    ---
+    tags:
+      - Upload
+    parameters:
+      - name: upload_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: Bytes received so far; resume by sending the rest from there
+        schema:
+          type: object
+          properties:
+            received:
+              type: integer
+            size:
+              type: integer
+      404:
+        description: Unknown or expired upload
+    """
+    session = file_service.get_upload_session(upload_id)
+    if not session:
+        return jsonify({"error": "Unknown upload"}), 404
+    return jsonify({"received": session["received"], "size": session["size"]}), 200
+
+
+@app.route("/api/upload/<upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id):
+    """
+    Upload one chunk of a resumable upload
+    ---
+    tags:
+      - Upload
+    consumes:
+      - application/octet-stream
+    parameters:
+      - name: upload_id
+        in: path
+        type: string
+        required: true
+      - name: Content-Range
+        in: header
+        type: string
+        required: true
+        description: e.g. "bytes 0-8388607/20000000"; must start at the received offset
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: string
+          format: binary
+    responses:
+      200:
+        description: Chunk stored
+        schema:
+          type: object
+          properties:
+            received:
+              type: integer
+      202:
+        description: >
+          Last chunk stored (or all bytes were already received), the
+          SHA-256 matched and processing is queued
+        schema:
+          type: object
+          properties:
+            task_id:
+              type: string
+      400:
+        description: >
+          Missing Content-Range, a body that does not match it, or the content
+          did not match its size or SHA-256
+      404:
+        description: Unknown or expired upload
+      409:
+        description: The chunk does not start at the received offset (returned in the body)
+    """
+    session = file_service.get_upload_session(upload_id)
+    if not session:
+        return jsonify({"error": "Unknown upload"}), 404
+    content_range = parse_content_range_header(request.headers.get("Content-Range"))
+    if content_range is None or content_range.length != session["size"]:
+        return jsonify({"error": "Content-Range with the file's total size is required"}), 400
+    # once every byte is in, any chunk (e.g. the last one again, after its
+    # request timed out while finishing) finishes the upload
+    if session["received"] < session["size"]:
+        try:
+            received = file_service.write_upload_chunk(
+                upload_id, session, content_range.start, content_range.stop, request.stream
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if received is None:
+            current = file_service.get_upload_session(upload_id) or session
+            return jsonify(
+                {"error": "Chunk does not start at the received offset", "received": current["received"]}
+            ), 409
+        if received < session["size"]:
+            return jsonify({"received": received}), 200
+
+    try:
+        finished = file_service.finish_upload(upload_id, session)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if finished is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    unique_id, old_id = finished
+    if not old_id:
+        enqueue_classification(unique_id, session["classification_types"])
+    return jsonify({"task_id": unique_id}), 202
+
+# statuses after which a task's status never changes
+FINAL_STATUSES = {"Success", "FAILURE", "REVOKED", "Invalid"}
+
+
+def task_status(id, info=None):
+    """Status body and http code for GET /api/task/<id>."""
+    if info is None:
+        info = file_service.get_status_info(id)
+    if not info or not info[1]:
+        return {"status": "Invalid"}, 404
+    original_id, state = info[:2]
+    if state == "success":
+        return {"status": "Success", "download_url": f"/api/download/{id}"}, 200
+    elif state == "pending":
+        return {"status": "Pending"}, 202
+    task = classification_task.AsyncResult(original_id)
+    if task.state == "PENDING":
+        # the task result may have expired from the backend
+        return {"status": "FAILURE" if state == "failure" else "Pending"}, 202
+    elif task.state == "PROCESSING":
+        meta = task.info
+        if meta.get("shards"):
+            meta = sharded_progress(original_id, meta)
+            if meta is None:
+                return {"status": "FAILURE"}, 202
+        return {
+            "status": "Processing",
+            "current": meta.get("current", 0),
+            "total": meta.get("total", 0),
+            "rows_per_sec": meta.get("rows_per_sec", 0),
+            "elapsed": meta.get("elapsed", 0),
+            "eta": meta.get("eta"),
+        }, 202
+    else:
+        result = {"status": str(task.state)}
+        if app.debug:
+            result["info"] = str(task.info)
+        return result, 202
+
+
+def status_etag(body):
+    return hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def status_response(body, code):
+    etag = status_etag(body)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(body)
+        response.status_code = code
+    response.set_etag(etag)
+    return response
+
+
+def sse_message(body):
+    return f"data: {json.dumps(body)}\n\n"
+
+
 @app.route("/api/task/<id>", methods=["GET"])
 def get_task_status(id):
     """
@@ -81,6 +438,19 @@ def get_task_status(id):
         type: string
         required: true
         description: The ID of the task (returned from the upload endpoint)
+      - name: wait
+        in: query
+        type: number
+        required: false
+        description: >
+          Long poll: together with an If-None-Match header holding the ETag of
+          the last response, wait up to this many seconds for the status to
+          change before answering 304 Not Modified.
+      - name: If-None-Match
+        in: header
+        type: string
+        required: false
+        description: ETag of the last status the client has seen
     responses:
       200:
         description: Task status
@@ -107,6 +477,17 @@ def get_task_status(id):
             total:
               type: integer
               description: Total number of steps in the task
+            rows_per_sec:
+              type: number
+              description: Processing throughput so far
+            elapsed:
+              type: number
+              description: Seconds since processing started
+            eta:
+              type: number
+              description: Estimated seconds until the task finishes (null until known)
+      304:
+        description: The status still matches the If-None-Match ETag
       404:
         description: Task not found
         schema:
@@ -116,49 +497,126 @@ def get_task_status(id):
               type: string
               description: "Invalid"
     """
-    original_id = file_service.get_original_id(id)
-    if not original_id:
-        original_id = id
-    state = file_service.get_state(original_id)
-    if not state:
+    wait = min(request.args.get("wait", 0, type=float), Config.LONG_POLL_MAX_WAIT)
+    info = file_service.get_status_info(id)
+    if not info or not info[1] or wait <= 0 or not request.if_none_match:
+        return status_response(*task_status(id, info))
+
+    # long poll: hold the request until the status differs from the client's copy
+    events = progress_events.subscribe(info[0])
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            body, code = task_status(id)
+            etag = status_etag(body)
+            remaining = deadline - time.monotonic()
+            if etag not in request.if_none_match or remaining <= 0:
+                break
+            try:
+                # without an event bus, fall back to re-checking once a second
+                events.get(timeout=remaining if progress_events.enabled else min(remaining, 1))
+            except queue.Empty:
+                pass
+    finally:
+        progress_events.unsubscribe(info[0], events)
+    return status_response(body, code)
+
+
+@app.route("/api/task/<id>/events", methods=["GET"])
+def task_events(id):
+    """
+    Stream the status of a processing task as Server-Sent Events
+    ---
+    tags:
+      - Task
+    parameters:
+      - name: id
+        in: path
+        type: string
+        required: true
+        description: The ID of the task (returned from the upload endpoint)
+    produces:
+      - text/event-stream
+    responses:
+      200:
+        description: >
+          A stream of `data:` events with the same body as GET /api/task/{id}.
+          The first event is the current status, later events are pushed as
+          the task progresses, and the stream ends after a final status
+          ("Success" with its download_url, or a failure).
+      404:
+        description: Task not found
+    """
+    info = file_service.get_status_info(id)
+    if not info or not info[1]:
         return jsonify({"status": "Invalid"}), 404
-    if state == "success":
-        return (
-            jsonify(
-                {
-                    "status": "Success",
-                    "download_url": f"/api/download/{id}",
-                }
-            ),
-            200,
-        )
-    elif state == "pending":
-        return jsonify({"status": "Pending"}), 202
-    task = classification_task.AsyncResult(original_id)
-    if task.state == "PENDING":
-        return jsonify({"status": "Pending"}), 202
-    elif task.state == "PROCESSING":
-        return (
-            jsonify(
-                {
-                    "status": "Processing",
-                    "current": task.info.get("current", 0),
-                    "total": task.info.get("total", 0),
-                }
-            ),
-            202,
-        )
+    original_id = info[0]
+    # subscribe before reading the status, so no event can fall in between
+    events = progress_events.subscribe(original_id)
+    body, _ = task_status(id, info)
+
+    def stream():
+        nonlocal body
+        try:
+            yield sse_message(body)
+            while body["status"] not in FINAL_STATUSES:
+                try:
+                    event = events.get(timeout=Config.SSE_KEEPALIVE)
+                except queue.Empty:
+                    # quiet task, or no event bus: re-check the status, then keep alive
+                    latest, _ = task_status(id)
+                    if latest != body:
+                        body = latest
+                        yield sse_message(body)
+                    else:
+                        yield ": keep-alive\n\n"
+                    continue
+                event.pop("task_id", None)
+                if "shard" in event:
+                    # one shard's progress: report the whole upload's instead
+                    event, _ = task_status(id)
+                    if event == body:
+                        continue
+                elif event["status"] == "Success":
+                    event["download_url"] = f"/api/download/{id}"
+                body = event
+                yield sse_message(body)
+        finally:
+            progress_events.unsubscribe(original_id, events)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def negotiate_download_format():
+    """(format, content encoding) for a download, or None if nothing acceptable."""
+    available = available_formats()
+    fmt = request.args.get("format")
+    if fmt:
+        # explicitly asked for: served as a file of that type
+        return (fmt, None) if fmt in available else None
+    tables = {OUTPUT_FORMATS[f]["mimetype"]: f for f in ("csv", "parquet", "arrow") if f in available}
+    if request.accept_mimetypes:
+        fmt = tables.get(request.accept_mimetypes.best_match(list(tables)))
     else:
-        result = {"status": str(task.state)}
-        if app.debug:
-            result["info"] = str(task.info)
-        return jsonify(result), 202
+        fmt = "csv"
+    if fmt != "csv":
+        return (fmt, None) if fmt else None
+    # csv: compress on the wire if the client accepts it
+    encodings = {OUTPUT_FORMATS[f]["encoding"]: f for f in ("csv.zst", "csv.gz") if f in available}
+    encoding = request.accept_encodings.best_match(list(encodings) + ["identity"])
+    if encoding in encodings:
+        return encodings[encoding], encoding
+    return "csv", None
 
 
 @app.route("/api/download/<id>", methods=["GET"])
 def download_file(id):
     """
-    Download the processed CSV file
+    Download the processed file
     ---
     tags:
       - Download
@@ -168,13 +626,40 @@ def download_file(id):
         type: string
         required: true
         description: The ID of the processed file (from the task status endpoint)
+      - name: format
+        in: query
+        type: string
+        enum: [csv, csv.gz, csv.zst, parquet, arrow]
+        required: false
+        description: >
+          File format. Without it, the format follows the Accept header
+          (text/csv, application/vnd.apache.parquet,
+          application/vnd.apache.arrow.file) and csv is compressed on the wire
+          per Accept-Encoding (zstd, gzip).
+      - name: Range
+        in: header
+        type: string
+        required: false
+        description: Byte range, to resume a download
+      - name: If-None-Match
+        in: header
+        type: string
+        required: false
+        description: ETag of a copy the client already has
     responses:
       200:
-        description: The processed CSV file
+        description: The processed file
         headers:
           Content-Disposition:
             type: string
             description: The filename of the downloaded file (e.g., "processed_original_filename.csv")
+          ETag:
+            type: string
+            description: Derived from the output name and the format
+      206:
+        description: The requested byte range
+      304:
+        description: Not modified
       404:
         description: File not found
         schema:
@@ -183,16 +668,429 @@ def download_file(id):
             error:
               type: string
               description: "File not found"
+      406:
+        description: Requested format is not available
     """
-    original_filename = file_service.get_original_filename(id)
-    if not original_filename:
+    info = file_service.get_status_info(id)
+    if not info or not info[3]:
+        return jsonify({"error": "File not found"}), 404
+    _, state, hash_value, original_filename, output_name = info
+    if state != "success":
         return jsonify({"error": "File not found"}), 404
-    return send_from_directory(
-        Config.OUTPUT_FOLDER,
-        file_service.get_hash(id),
+    negotiated = negotiate_download_format()
+    if not negotiated:
+        return jsonify({"error": f"Available formats: {', '.join(available_formats())}"}), 406
+    fmt, encoding = negotiated
+    if not os.path.isfile(os.path.join(Config.OUTPUT_FOLDER, output_name)):
+        # evicted since the status was cached
+        return jsonify({"error": "File not found"}), 404
+    file_service.touch(hash_value)
+    path = file_service.get_output_artifact(output_name, fmt)
+    name = os.path.splitext(original_filename)[0]
+    if encoding:
+        mimetype, download_name = "text/csv", f"processed_{name}.csv"
+    else:
+        mimetype, download_name = OUTPUT_FORMATS[fmt]["mimetype"], f"processed_{name}.{fmt}"
+    # send_file answers Range and If-None-Match/If-Range against this etag
+    response = send_file(
+        path,
+        mimetype=mimetype,
         as_attachment=True,
-        download_name=f"processed_{original_filename}",
+        download_name=download_name,
+        etag=f"{output_name}.{fmt}",
+        conditional=True,
     )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.accept_ranges = "bytes"
+    response.vary.update(["Accept", "Accept-Encoding"])
+    return response
+
+
+@app.route("/api/result/<id>/summary", methods=["GET"])
+def get_result_summary(id):
+    """
+    Get the label counts of a classification without downloading it
+    ---
+    tags:
+      - Download
+    parameters:
+      - name: id
+        in: path
+        type: string
+        required: true
+        description: The task ID
+    responses:
+      200:
+        description: >
+          Counts and shares of every label and the mean confidence (softmax
+          probability of the predicted label), per classification type. While
+          the task is processing they cover the rows classified so far and
+          complete is false.
+        schema:
+          type: object
+          properties:
+            state:
+              type: string
+            complete:
+              type: boolean
+            rows:
+              type: integer
+            types:
+              type: object
+              description: "{type: {counts: {label: n}, shares: {label: fraction}, mean_confidence: number}}"
+      404:
+        description: Unknown task, or its output was evicted
+    """
+    info = file_service.get_status_info(id)
+    if not info or not info[1]:
+        return jsonify({"error": "Task not found"}), 404
+    state, output_name = info[1], info[4]
+    summary, complete = file_service.get_summary(id)
+    if state == "success" and not complete:
+        # finished before summaries were kept
+        summary, complete = file_service.summarize_output(id, output_name), True
+        if summary is None:
+            return jsonify({"error": "Summary not found"}), 404
+    return jsonify({"state": state, "complete": complete, **summary.as_dict()}), 200
+
+
+@app.route("/api/profile/<id>", methods=["GET"])
+def get_profile(id):
+    """
+    Get the profile of a profiled classification
+    ---
+    tags:
+      - Profile
+    parameters:
+      - name: id
+        in: path
+        type: string
+        required: true
+        description: The task ID
+    responses:
+      200:
+        description: >
+          Summary of the profile: per-stage seconds of the pipeline, the
+          Python functions with the most self time (cProfile) and the torch
+          ops with the most self CPU time by input shape, plus links to the
+          full files
+        schema:
+          type: object
+          properties:
+            seconds:
+              type: number
+            stages:
+              type: object
+            python_hotspots:
+              type: array
+              items:
+                type: object
+            torch_hotspots:
+              type: array
+              items:
+                type: object
+            trace_url:
+              type: string
+              description: torch profiler trace (gzipped chrome trace JSON)
+            pstats_url:
+              type: string
+              description: cProfile stats, for pstats or snakeviz
+      404:
+        description: Unknown task, or its file was not profiled
+    """
+    output_name = file_service.get_output_name(id)
+    path = output_name and file_service.get_profile_file(output_name, "summary")
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    with open(path) as f:
+        summary = json.load(f)
+    summary["trace_url"] = f"/api/profile/{id}/trace"
+    summary["pstats_url"] = f"/api/profile/{id}/pstats"
+    return jsonify(summary), 200
+
+
+@app.route("/api/profile/<id>/<any(trace, pstats):kind>", methods=["GET"])
+def download_profile(id, kind):
+    """
+    Download the torch trace or the cProfile stats of a profiled classification
+    ---
+    tags:
+      - Profile
+    parameters:
+      - name: id
+        in: path
+        type: string
+        required: true
+        description: The task ID
+      - name: kind
+        in: path
+        type: string
+        enum: [trace, pstats]
+        required: true
+    responses:
+      200:
+        description: >
+          trace: gzipped chrome trace JSON (chrome://tracing, Perfetto);
+          pstats: cProfile stats (python -m pstats, snakeviz)
+      404:
+        description: Unknown task, or its file was not profiled
+    """
+    output_name = file_service.get_output_name(id)
+    path = output_name and file_service.get_profile_file(output_name, kind)
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    if kind == "trace":
+        mimetype, download_name = "application/gzip", f"trace_{id}.json.gz"
+    else:
+        mimetype, download_name = "application/octet-stream", f"profile_{id}.pstats"
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+
+@app.route("/api/stats/cache", methods=["GET"])
+def get_cache_stats():
+    """
+    Get prediction cache statistics
+    ---
+    tags:
+      - Stats
+    responses:
+      200:
+        description: Size and hit rate of the comment-level prediction cache
+        schema:
+          type: object
+          properties:
+            entries:
+              type: integer
+              description: Number of cached predictions
+            max_entries:
+              type: integer
+              description: Cache size cap before least-recently-used eviction
+            hits:
+              type: integer
+              description: Lookups answered from the cache
+            misses:
+              type: integer
+              description: Lookups that needed the model
+            hit_rate:
+              type: number
+              description: hits / (hits + misses)
+    """
+    return jsonify(prediction_cache.stats()), 200
+
+
+@app.route("/api/classify", methods=["POST"])
+def classify_comments():
+    """
+    Classify a few comments synchronously
+    ---
+    tags:
+      - Classify
+    consumes:
+      - application/json
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - comments
+          properties:
+            comments:
+              type: array
+              items:
+                type: string
+              description: At most CLASSIFY_MAX_COMMENTS comments; use /api/upload for files
+            classification_types:
+              type: array
+              items:
+                type: string
+              default: [sentiment]
+    responses:
+      200:
+        description: >
+          One result per comment, in order. Concurrent requests are batched
+          together by the inference server.
+        schema:
+          type: object
+          properties:
+            results:
+              type: array
+              items:
+                type: object
+            latency_ms:
+              type: number
+      400:
+        description: Invalid request body
+      502:
+        description: The inference server failed to classify the comments
+      503:
+        description: The inference server is not reachable, or its authkey does not match
+    """
+    start = time.perf_counter()
+    body = request.get_json(silent=True) or {}
+    comments = body.get("comments")
+    if not isinstance(comments, list) or not comments or not all(isinstance(c, str) for c in comments):
+        return jsonify({"error": "comments must be a non-empty list of strings"}), 400
+    if len(comments) > Config.CLASSIFY_MAX_COMMENTS:
+        return jsonify(
+            {"error": f"At most {Config.CLASSIFY_MAX_COMMENTS} comments, upload a CSV for more"}
+        ), 400
+    classification_types = parse_classification_types(body.get("classification_types", ["sentiment"]))
+    if not classification_types:
+        return jsonify({"error": "Unknown or unavailable classification_types"}), 400
+    try:
+        labels = inference_client.classify(comments, classification_types)
+    except (ConnectionError, OSError, AuthenticationError) as e:
+        app.logger.error(f"inference server: {str(e)}")
+        return jsonify({"error": "Inference server unavailable"}), 503
+    except RuntimeError as e:
+        # the server reported an error of its own
+        app.logger.error(f"inference server: {str(e)}")
+        return jsonify({"error": "Inference server failed"}), 502
+    results = [
+        {"comment": comment, **dict(zip(classification_types, row))}
+        for comment, row in zip(comments, labels)
+    ]
+    latency = time.perf_counter() - start
+    classify_latency.add(latency)
+    return jsonify({"results": results, "latency_ms": round(latency * 1000, 2)}), 200
+
+
+@app.route("/api/stats/classify", methods=["GET"])
+def get_classify_stats():
+    """
+    Get latency statistics of /api/classify
+    ---
+    tags:
+      - Stats
+    responses:
+      200:
+        description: >
+          p50/p99 over recent requests, end to end in this api process and
+          inside the inference server, plus its micro-batch sizes
+        schema:
+          type: object
+          properties:
+            api:
+              type: object
+            server:
+              type: object
+    """
+    try:
+        server = inference_client.stats()
+    except (ConnectionError, OSError, AuthenticationError, RuntimeError):
+        server = None
+    return jsonify({"api": classify_latency.summary(), "server": server}), 200
+
+
+@app.route("/api/stats/storage", methods=["GET"])
+def get_storage_stats():
+    """
+    Get disk usage of uploads and outputs
+    ---
+    tags:
+      - Stats
+    responses:
+      200:
+        description: Usage against the quota enforced by the storage maintenance task
+        schema:
+          type: object
+          properties:
+            total_bytes:
+              type: integer
+            quota_bytes:
+              type: integer
+              description: 0 when eviction is disabled
+            used_fraction:
+              type: number
+            hash_bytes:
+              type: integer
+              description: Bytes of stored files (uploads, outputs, converted downloads)
+            other_bytes:
+              type: integer
+              description: Bytes of unfinished uploads and temporary files
+            hashes:
+              type: integer
+            unreferenced_hashes:
+              type: integer
+              description: Stored files no upload refers to; evicted first
+            in_flight_hashes:
+              type: integer
+              description: Files with a task pending or running; never evicted
+            oldest_access:
+              type: number
+              description: Unix time of the least recently used file
+    """
+    return jsonify(storage_manager.usage()), 200
+
+
+@app.route("/api/stats/queues", methods=["GET"])
+def get_queue_stats():
+    """
+    Get queue depth and queue wait per job class
+    ---
+    tags:
+      - Stats
+    responses:
+      200:
+        description: >
+          Per job class (small, medium, large): messages in its Celery queue,
+          uploads not started yet, and the p50/p95 seconds from upload to task
+          start of the jobs started in the last QUEUE_STATS_WINDOW seconds
+        schema:
+          type: object
+          additionalProperties:
+            type: object
+            properties:
+              queue:
+                type: string
+              depth:
+                type: integer
+              pending:
+                type: integer
+              started:
+                type: integer
+              wait_p50_seconds:
+                type: number
+              wait_p95_seconds:
+                type: number
+    """
+    depths = queue_depths()
+    jobs = file_service.get_job_stats(time.time() - Config.QUEUE_STATS_WINDOW)
+    stats = {}
+    for job_class in JOB_CLASSES:
+        pending, waits = jobs.get(job_class, (0, []))
+        p50, p95 = percentile(waits, 0.50), percentile(waits, 0.95)
+        stats[job_class] = {
+            "queue": queue_name(job_class),
+            "depth": depths.get(queue_name(job_class)),
+            "pending": pending,
+            "started": len(waits),
+            "wait_p50_seconds": round(p50, 3) if p50 is not None else None,
+            "wait_p95_seconds": round(p95, 3) if p95 is not None else None,
+        }
+    return jsonify(stats), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Prometheus metrics of the api
+    ---
+    tags:
+      - Stats
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: >
+          Upload throughput, DBService query latency and the Celery queue
+          depth, in the Prometheus text format. Workers export their
+          classification metrics on WORKER_METRICS_PORT.
+    """
+    return Response(metrics.render(queue_depths), mimetype=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
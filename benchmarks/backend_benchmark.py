@@ -0,0 +1,66 @@
+"""Label parity and throughput of the inference backends against fp32 eager PyTorch.
+
+Usage: python benchmarks/backend_benchmark.py --csv sample.csv [--rows N]
+       [--backends eager int8 onnx] [--threads T]
+
+Every backend classifies the same sample of comments. The report gives each
+backend's load time, rows/sec and share of labels that agree with the eager
+fp32 model. Run with --threads 1 to compare rows/sec per core.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+import torch  # noqa: E402
+
+from models.backends import BACKENDS  # noqa: E402
+from models.sentiment_model import SentimentModel  # noqa: E402
+from utils.config import Config  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", required=True, help="CSV with a 'comment' column")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--model-path", default=Config.MODEL_PATH)
+    parser.add_argument("--label-path", default=Config.LABEL_PATH)
+    parser.add_argument("--cache-dir", default=Config.BACKEND_CACHE_DIR)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    comments = pd.read_csv(args.csv, nrows=args.rows)["comment"].astype(str).tolist()
+    report = {"rows": len(comments), "threads": torch.get_num_threads(), "backends": {}}
+    reference = None
+    for name in ["eager"] + [b for b in args.backends if b != "eager"]:
+        start = time.perf_counter()
+        model = SentimentModel(args.model_path, args.label_path, backend=name, cache_dir=args.cache_dir)
+        load_time = time.perf_counter() - start
+        model.predict_batch(comments[:8])  # warm up
+        start = time.perf_counter()
+        labels = model.predict_batch(comments, max_tokens=Config.BATCH_TOKEN_BUDGET)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = labels
+        report["backends"][name] = {
+            "load_seconds": round(load_time, 3),
+            "rows_per_sec": round(len(comments) / seconds, 1),
+            "speedup": None,
+            "label_agreement": sum(a == b for a, b in zip(reference, labels)) / len(labels),
+            "model_bytes": model.memory_footprint(),
+        }
+    eager_rate = report["backends"]["eager"]["rows_per_sec"]
+    for stats in report["backends"].values():
+        stats["speedup"] = round(stats["rows_per_sec"] / eager_rate, 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Latency of POST /api/classify under concurrent clients.
+
+Usage: python benchmarks/classify_benchmark.py [--url http://localhost:5000]
+       [--clients 16] [--requests 50] [--comments 3]
+
+Needs the API and `python -m services.inference_server` running. Each client
+sends `--requests` requests of `--comments` comments one after the other.
+The report gives the client-side p50/p99 and the server's own latency and
+micro-batch sizes from /api/stats/classify. Compare runs with
+MICROBATCH_MAX_WAIT_MS=0 (no coalescing) against the default.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.inference_server import LatencyStats  # noqa: E402
+
+
+def post(url, body):
+    request = urllib.request.Request(
+        url, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--comments", type=int, default=3)
+    args = parser.parse_args()
+
+    body = {"comments": ["the service was quick and friendly"] * args.comments}
+    post(f"{args.url}/api/classify", body)  # warm up
+    latency = LatencyStats(size=args.clients * args.requests)
+
+    def client():
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            post(f"{args.url}/api/classify", body)
+            latency.add(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    with urllib.request.urlopen(f"{args.url}/api/stats/classify") as response:
+        stats = json.load(response)
+    report = {
+        "clients": args.clients,
+        "requests": args.clients * args.requests,
+        "comments_per_request": args.comments,
+        "requests_per_sec": round(args.clients * args.requests / seconds, 1),
+        "client": latency.summary(),
+        "server": stats["server"],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Concurrent writers and readers against DBService.
+
+Usage: python benchmarks/db_concurrency_benchmark.py [--writers N] [--readers M]
+       [--seconds S] [--processes] [--journal-mode WAL DELETE ...]
+
+Writers insert records and move them through their states, the way uploads
+and workers do. Readers poll states and hashes, the way status requests do.
+Each journal mode gets a fresh database, so WAL can be compared with the old
+rollback journal. Threads share one DBService, as gunicorn threads do.
+--processes gives each client its own process and DBService, as gunicorn and
+Celery workers do.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.db_service import DBService  # noqa: E402
+
+
+def writer(db, deadline, out):
+    latencies, errors = [], 0
+    while time.perf_counter() < deadline:
+        u_id = str(uuid.uuid4())
+        start = time.perf_counter()
+        try:
+            hash_value = uuid.uuid4().hex
+            db.save_upload(u_id, "bench.csv", hash_value, 1024, "bench", "sentiment", hash_value)
+            db.update_file_state(u_id, "processing")
+            db.update_file_state(u_id, "success")
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    out.put(("write", latencies, errors))
+
+
+def reader(db, deadline, ids, out):
+    latencies, errors = [], 0
+    i = 0
+    while time.perf_counter() < deadline:
+        u_id = ids[i % len(ids)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            db.get_file_state(u_id)
+            db.get_file_hash(u_id)
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    out.put(("read", latencies, errors))
+
+
+def process_client(role, db_file, journal_mode, deadline, ids, out):
+    db = DBService(db_file, journal_mode=journal_mode)
+    if role == "write":
+        writer(db, deadline, out)
+    else:
+        reader(db, deadline, ids, out)
+
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": round(len(latencies) / seconds, 1),
+        "errors": errors,
+        "p50_ms": round(statistics.median(latencies) * 1000, 3) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3) if latencies else None,
+    }
+
+
+def run(journal_mode, args):
+    db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db = DBService(db_file, journal_mode=journal_mode)
+    ids = []
+    for _ in range(1000):
+        u_id = str(uuid.uuid4())
+        hash_value = uuid.uuid4().hex
+        db.save_upload(u_id, "seed.csv", hash_value, 1024, "bench", "sentiment", hash_value)
+        ids.append(u_id)
+
+    if args.processes:
+        out = multiprocessing.Queue()
+        deadline = time.perf_counter() + args.seconds + 1  # allow for process start-up
+        workers = [
+            multiprocessing.Process(
+                target=process_client, args=(role, db_file, journal_mode, deadline, ids, out)
+            )
+            for role in ["write"] * args.writers + ["read"] * args.readers
+        ]
+        seconds = args.seconds + 1
+    else:
+        import queue
+
+        out = queue.Queue()
+        deadline = time.perf_counter() + args.seconds
+        workers = [threading.Thread(target=writer, args=(db, deadline, out)) for _ in range(args.writers)]
+        workers += [
+            threading.Thread(target=reader, args=(db, deadline, ids, out)) for _ in range(args.readers)
+        ]
+        seconds = args.seconds
+    for w in workers:
+        w.start()
+    results = {"write": ([], 0), "read": ([], 0)}
+    for _ in workers:
+        kind, latencies, errors = out.get()
+        total, total_errors = results[kind]
+        results[kind] = (total + latencies, total_errors + errors)
+    for w in workers:
+        w.join()
+    return {kind: summarize(lat, err, seconds) for kind, (lat, err) in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument("--journal-mode", nargs="+", default=["DELETE", "WAL"])
+    args = parser.parse_args()
+
+    report = {
+        "writers": args.writers,
+        "readers": args.readers,
+        "seconds": args.seconds,
+        "clients": "processes" if args.processes else "threads",
+    }
+    for mode in args.journal_mode:
+        report[mode] = run(mode, args)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
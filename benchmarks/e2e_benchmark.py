@@ -0,0 +1,230 @@
+"""End-to-end benchmark suite that runs offline on a plain CPU box.
+
+Usage: python benchmarks/e2e_benchmark.py [--rows 1000 10000 100000]
+       [--out results.json] [--workdir DIR] [--requests 200] [--db-queries 2000]
+
+Builds a tiny random BERT (benchmarks/tiny_model.py) in a scratch directory
+and points the app at it, with Celery in eager mode and in-memory broker and
+result backend, so neither network, weights nor Redis are needed. Sections:
+
+- model: load and warmup time of the worker model registry
+- classification: classification_task over synthetic CSVs of each --rows
+  size, once with a cold prediction cache and once warm
+- api: /api/upload (new and duplicate files) and /api/task/<id> (running and
+  finished tasks) latency through the Flask test client
+- db: latency of the DBService queries on the hot paths
+
+The report is JSON (stdout, and --out) with environment metadata, so runs
+can be compared over time.
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.tiny_model import build_tiny_model, synthetic_comments  # noqa: E402
+
+
+def summarize(samples):
+    """p50/p99/mean of durations in seconds, in ms."""
+    samples = sorted(samples)
+    if not samples:
+        return None
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def csv_bytes(comments):
+    import pandas as pd
+
+    return pd.DataFrame({"comment": comments}).to_csv(index=False).encode()
+
+
+def register_csv(file_service, data, name):
+    """Store a CSV the way an upload does, returning its upload id."""
+    path = os.path.join(file_service.upload_folder, f"{name}.tmp")
+    with open(path, "wb") as f:
+        f.write(data)
+    unique_id, _ = file_service._register_upload(
+        path, f"{name}.csv", hashlib.sha256(data).hexdigest(), ["sentiment"]
+    )
+    return unique_id
+
+
+def bench_model(classification):
+    classification.registry.load_all()
+    stats = classification.registry.stats()["sentiment"]
+    return {
+        "load_seconds": round(stats["load_time"], 3),
+        "warmup_seconds": round(stats["warmup_time"] or 0, 3),
+        "model_bytes": stats["model_bytes"],
+    }
+
+
+def bench_classification(classification, file_service, rows_list):
+    results = []
+    for rows in rows_list:
+        comments = synthetic_comments(rows, seed=rows)
+        entry = {"rows": rows}
+        # the warm run gets the same comments in another order, so another
+        # file, but every prediction comes from the cache
+        for run, data in (("cold", csv_bytes(comments)), ("warm", csv_bytes(comments[::-1]))):
+            unique_id = register_csv(file_service, data, f"bench-{rows}-{run}")
+            seconds, result = timed(
+                classification.classification_task.apply, args=[unique_id], task_id=unique_id
+            )
+            if result.state != "SUCCESS":
+                raise RuntimeError(f"classification of {rows} rows failed: {result.traceback}")
+            entry[run] = {"seconds": round(seconds, 3), "rows_per_sec": round(rows / seconds, 1)}
+        results.append(entry)
+    return results
+
+
+def bench_api(app_module, requests):
+    client = app_module.app.test_client()
+    # queue instead of running, so only the api path is measured
+    app_module.celery.conf.task_always_eager = False
+    duplicate = csv_bytes(synthetic_comments(200, seed=1))
+    samples = {"upload_new": [], "upload_duplicate": [], "status_running": [], "status_finished": []}
+    task_ids = []
+    for i in range(requests):
+        for kind, data in (
+            ("upload_new", csv_bytes(synthetic_comments(200, seed=1000 + i))),
+            ("upload_duplicate", duplicate),
+        ):
+            seconds, response = timed(
+                client.post, "/api/upload", data={"file": (io.BytesIO(data), "bench.csv")}
+            )
+            if response.status_code != 202:
+                raise RuntimeError(f"upload failed: {response.get_data(as_text=True)}")
+            samples[kind].append(seconds)
+            task_ids.append(response.get_json()["task_id"])
+    # uploads whose classification has finished (from the classification section)
+    db = app_module.file_service.db_service
+    finished = [
+        unique_id
+        for (unique_id,) in db.conn.execute("SELECT u_id FROM records")
+        if db.get_status_info(unique_id)[1] == "success"
+    ]
+    for i in range(requests):
+        seconds, _ = timed(client.get, f"/api/task/{task_ids[i % len(task_ids)]}")
+        samples["status_running"].append(seconds)
+        if finished:
+            seconds, _ = timed(client.get, f"/api/task/{finished[i % len(finished)]}")
+            samples["status_finished"].append(seconds)
+    app_module.celery.conf.task_always_eager = True
+    return {kind: summarize(values) for kind, values in samples.items()}
+
+
+def bench_db(file_service, queries):
+    db = file_service.db_service
+    rows = db.conn.execute(
+        "SELECT records.u_id, hashs.hash, hashs.size FROM records JOIN hashs USING (hash_id)"
+    ).fetchall()
+    samples = {"get_status_info": [], "check_hash": [], "get_file_hash": [], "save_checkpoint": []}
+    for i in range(queries):
+        unique_id, hash_value, size = rows[i % len(rows)]
+        samples["get_status_info"].append(timed(db.get_status_info, unique_id)[0])
+        samples["check_hash"].append(timed(db.check_hash, hash_value, size)[0])
+        samples["get_file_hash"].append(timed(db.get_file_hash, unique_id)[0])
+        samples["save_checkpoint"].append(
+            timed(db.save_checkpoint, "bench-task", unique_id, i, i * 100)[0]
+        )
+    db.delete_checkpoint("bench-task")
+    return {query: summarize(values) for query, values in samples.items()}
+
+
+def metadata(args):
+    import torch
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--db-queries", type=int, default=2000)
+    parser.add_argument("--workdir", default=None, help="scratch directory (default: a temp dir)")
+    parser.add_argument("--out", default=None, help="also write the JSON report here")
+    args = parser.parse_args()
+    if args.out:
+        args.out = os.path.abspath(args.out)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="e2e-benchmark-")
+    model_path, label_path = build_tiny_model(os.path.join(workdir, "tiny"))
+    # Config reads the environment on import, so this comes first
+    os.environ.update(
+        DEBUG="false",
+        MODEL_PATH=model_path,
+        LABEL_PATH=label_path,
+        UPLOAD_FOLDER=os.path.join(workdir, "uploads"),
+        OUTPUT_FOLDER=os.path.join(workdir, "outputs"),
+        PREDICTION_CACHE_DB=os.path.join(workdir, "prediction_cache.db"),
+        CELERY_BROKER_URL="memory://",
+        CELERY_RESULT_BACKEND="cache+memory://",
+        SHARD_THRESHOLD_ROWS=str(10**9),
+    )
+    # DBService keeps its database in the working directory
+    os.chdir(workdir)
+
+    import app as app_module
+    from services import classification
+
+    classification.celery.conf.task_always_eager = True
+
+    report = {"meta": metadata(args), "workdir": workdir}
+    report["model"] = bench_model(classification)
+    report["classification"] = bench_classification(
+        classification, app_module.file_service, args.rows
+    )
+    report["api"] = bench_api(app_module, args.requests)
+    report["db"] = bench_db(app_module.file_service, args.db_queries)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Per-worker memory with and without preloading the model before the fork.
+
+Usage: python benchmarks/memory_benchmark.py [--workers 4] [--model-path DIR
+       --label-path FILE] [--out results.json]
+
+Runs the worker startup hooks of services.classification the way a prefork
+pool does: the parent calls preload_models (or not, with PRELOAD_MODELS=false),
+forks --workers children, and each child calls load_models and classifies a
+few comments. Every child reports its rss, pss (shared pages split between
+the processes using them) and private memory before and after, while all of
+them are alive. Without --model-path a random encoder the size of bert-base
+is built in a temp dir, so no network or weights are needed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def child(classification, barrier, results, comments):
+    from models.registry import memory_usage
+
+    before = memory_usage()
+    classification.load_models()
+    loaded = memory_usage()
+    classification.registry.get("sentiment").predict_batch(comments)
+    # measured with every sibling alive, so shared pages are split between all of them
+    barrier.wait()
+    results.put({"pid": os.getpid(), "before": before, "loaded": loaded, "after": memory_usage()})
+    barrier.wait()
+
+
+def run_mode(workers):
+    """Body of one measurement, in a fresh interpreter configured by the environment."""
+    import multiprocessing
+    import types
+    from celery.concurrency.prefork import TaskPool
+    from benchmarks.tiny_model import synthetic_comments
+    from models.registry import memory_usage
+    from services import classification
+
+    parent_before = memory_usage()
+    classification.preload_models(sender=types.SimpleNamespace(pool_cls=TaskPool))
+    parent_after = memory_usage()
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    comments = synthetic_comments(256, seed=1)
+    processes = [
+        context.Process(target=child, args=(classification, barrier, results, comments))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    children = sorted((results.get() for _ in processes), key=lambda r: r["pid"])
+    for process in processes:
+        process.join()
+    return {
+        "parent": {"before": parent_before, "after": parent_after},
+        "workers": children,
+        "total_pss": sum(r["after"]["pss"] or 0 for r in children),
+        "total_private": sum(r["after"]["private"] or 0 for r in children),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument("--label-path", default=None)
+    parser.add_argument("--out", default=None, help="also write the JSON report here")
+    parser.add_argument("--mode", choices=["preloaded", "per-child"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.workers)))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="memory-benchmark-")
+    if args.model_path:
+        model_path, label_path = args.model_path, args.label_path
+    else:
+        from benchmarks.tiny_model import build_tiny_model
+
+        model_path, label_path = build_tiny_model(
+            os.path.join(workdir, "model"), hidden_size=768, layers=12
+        )
+    report = {"workers": args.workers, "model_path": model_path}
+    for mode in ("per-child", "preloaded"):
+        env = dict(
+            os.environ,
+            DEBUG="false",
+            MODEL_PATH=model_path,
+            LABEL_PATH=label_path,
+            PRELOAD_MODELS="true" if mode == "preloaded" else "false",
+            SENTIMENT_BACKEND="eager",
+            UPLOAD_FOLDER=os.path.join(workdir, "uploads"),
+            OUTPUT_FOLDER=os.path.join(workdir, "outputs"),
+            PREDICTION_CACHE_DB=os.path.join(workdir, "prediction_cache.db"),
+            CELERY_BROKER_URL="memory://",
+            CELERY_RESULT_BACKEND="cache+memory://",
+        )
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--workers", str(args.workers)],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        report[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
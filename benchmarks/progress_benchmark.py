@@ -0,0 +1,79 @@
+"""Compare per-row progress updates with the throttled ProgressReporter.
+
+Usage: python benchmarks/progress_benchmark.py [--rows N] [--backend URL]
+
+Every update is a real write to the Celery result backend (Redis by default,
+from CELERY_RESULT_BACKEND). The loop does no other work, so the numbers are
+the pure cost of progress reporting for a file of N rows.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.classification import celery  # noqa: E402
+from utils.config import Config  # noqa: E402
+from utils.progress import ProgressReporter  # noqa: E402
+
+
+class BackendTask:
+    """Stand-in for a bound task: update_state writes straight to the backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.task_id = str(uuid.uuid4())
+        self.writes = 0
+
+    def update_state(self, state, meta):
+        self.backend.store_result(self.task_id, meta, state)
+        self.writes += 1
+
+
+def per_row(backend, rows):
+    task = BackendTask(backend)
+    start = time.perf_counter()
+    for idx in range(rows):
+        task.update_state(state="PROCESSING", meta={"current": idx, "total": rows})
+    return time.perf_counter() - start, task.writes
+
+
+def throttled(backend, rows, every_rows, every_ms):
+    task = BackendTask(backend)
+    start = time.perf_counter()
+    progress = ProgressReporter(task, rows, every_rows=every_rows, every_ms=every_ms)
+    for idx in range(rows):
+        progress.update(idx)
+    progress.update(rows, force=True)
+    return time.perf_counter() - start, task.writes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--backend", default=Config.CELERY_RESULT_BACKEND)
+    parser.add_argument("--every-rows", type=int, default=Config.PROGRESS_EVERY_ROWS)
+    parser.add_argument("--every-ms", type=int, default=Config.PROGRESS_EVERY_MS)
+    args = parser.parse_args()
+
+    celery.conf.result_backend = args.backend
+    backend = celery.backend
+    report = {"rows": args.rows, "backend": args.backend}
+    for name, run in [
+        ("per_row", lambda: per_row(backend, args.rows)),
+        ("throttled", lambda: throttled(backend, args.rows, args.every_rows, args.every_ms)),
+    ]:
+        seconds, writes = run()
+        report[name] = {
+            "seconds": round(seconds, 4),
+            "backend_writes": writes,
+            "us_per_row": round(seconds / args.rows * 1e6, 2),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
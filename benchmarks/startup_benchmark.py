@@ -0,0 +1,70 @@
+"""Measure how long it takes to import the Flask app, and guard that it stays light.
+
+Usage: python benchmarks/startup_benchmark.py [--runs N]
+
+Each run imports `app` in a fresh interpreter. The script exits non-zero if
+the import pulls in torch/transformers or loads a model, because the API
+process never runs inference.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "transformers", "models.sentiment_model", "models.bert_classifier"]
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+from services.classification import registry
+print(json.dumps({
+    "import_seconds": elapsed,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "heavy_modules": [m for m in %r if m in sys.modules],
+    "loaded_models": [n for n in registry.stats()],
+}))
+""" % (HEAVY_MODULES,)
+
+
+def run_once():
+    env = dict(os.environ)
+    env.setdefault("DEBUG", "false")
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    times = [r["import_seconds"] for r in runs]
+    report = {
+        "runs": args.runs,
+        "import_seconds_median": statistics.median(times),
+        "import_seconds_max": max(times),
+        "max_rss_kb": max(r["max_rss_kb"] for r in runs),
+        "heavy_modules": runs[0]["heavy_modules"],
+        "loaded_models": runs[0]["loaded_models"],
+    }
+    print(json.dumps(report, indent=2))
+    if report["heavy_modules"] or report["loaded_models"]:
+        print("importing app must not load models or torch/transformers", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
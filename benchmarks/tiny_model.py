@@ -0,0 +1,86 @@
+"""Build a tiny randomly initialized BERT classifier for offline benchmarks.
+
+Usage: python benchmarks/tiny_model.py <output dir>
+
+Writes `<dir>/model` (a 2-layer BertForSequenceClassification with a fast
+tokenizer), `<dir>/label_encoder.pkl`, and optionally `<dir>/theme_heads.pt`
+with `<dir>/themes.xlsx`. Its labels are meaningless, but it exercises
+exactly the code paths of the real model, without network access or weights.
+"""
+import os
+import pickle
+import sys
+
+WORDS = (
+    "the service was good bad slow quick friendly rude staff price delivery "
+    "late early great terrible okay product quality support refund order "
+    "again never always app website easy hard helpful broken"
+).split()
+LABELS = ["negative", "neutral", "positive"]
+
+
+def build_tiny_model(directory, seed=0, themes=False, hidden_size=32, layers=2):
+    """Write the tiny model to `directory`; returns (model path, label path).
+
+    `hidden_size=768, layers=12` gives an encoder the size of bert-base, for
+    memory measurements.
+    """
+    import torch
+    from sklearn.preprocessing import LabelEncoder
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+
+    model_path = os.path.join(directory, "model")
+    label_path = os.path.join(directory, "label_encoder.pkl")
+    os.makedirs(model_path, exist_ok=True)
+    vocab_path = os.path.join(directory, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS) + "\n")
+    BertTokenizerFast(vocab_path).save_pretrained(model_path)
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=5 + len(WORDS),
+        hidden_size=hidden_size,
+        num_hidden_layers=layers,
+        num_attention_heads=2,
+        intermediate_size=2 * hidden_size,
+        num_labels=len(LABELS),
+    )
+    BertForSequenceClassification(config).save_pretrained(model_path)
+    with open(label_path, "wb") as f:
+        pickle.dump(LabelEncoder().fit(LABELS), f)
+    if themes:
+        import pandas as pd
+
+        pd.DataFrame(
+            {"Main Theme": ["Service", "Service", "Product"], "Sub Theme": ["Staff", "Speed", "Quality"]}
+        ).to_excel(os.path.join(directory, "themes.xlsx"), index=False)
+        torch.save(
+            {
+                "main_theme.weight": torch.randn(2, config.hidden_size),
+                "main_theme.bias": torch.zeros(2),
+                "sub_theme.weight": torch.randn(3, config.hidden_size),
+                "sub_theme.bias": torch.zeros(3),
+            },
+            os.path.join(directory, "theme_heads.pt"),
+        )
+    return model_path, label_path
+
+
+def synthetic_comments(rows, seed=0, duplicate_fraction=0.2):
+    """`rows` random comments, about `duplicate_fraction` of them repeats."""
+    import random
+
+    rng = random.Random(seed)
+    comments = []
+    for _ in range(rows):
+        if comments and rng.random() < duplicate_fraction:
+            comments.append(rng.choice(comments))
+        else:
+            comments.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))))
+    return comments
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    print(build_tiny_model(sys.argv[1], themes=True))
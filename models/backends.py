@@ -0,0 +1,124 @@
+import os
+import torch
+
+
+def _save_atomic(save, path):
+    """Write a cache file under a temporary name first, so a crash never leaves half a file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class _PooledEncoder(torch.nn.Module):
+    """BertModel returning just the pooled output, the input of every classification head."""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.encoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        ).pooler_output
+
+
+class EagerBackend:
+    """fp32 PyTorch on the best available device."""
+
+    def __init__(self, encoder, cache_prefix, device):
+        self.device = device
+        self.encoder = _PooledEncoder(encoder).to(device).eval()
+
+    def __call__(self, inputs):
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            return self.encoder(**inputs)
+
+    def memory_footprint(self):
+        # quantized Linear layers keep their packed weights outside parameters()
+        state = self.encoder.state_dict()
+        return sum(
+            t.numel() * t.element_size() for t in state.values() if isinstance(t, torch.Tensor)
+        )
+
+
+class DynamicInt8Backend(EagerBackend):
+    """PyTorch dynamic int8 quantization of the Linear layers; CPU only."""
+
+    def __init__(self, encoder, cache_prefix, device):
+        path = f"{cache_prefix}.int8.pt"
+        if os.path.isfile(path):
+            # our own cache file, holding a pickled quantized module
+            quantized = torch.load(path, weights_only=False)
+        else:
+            quantized = torch.ao.quantization.quantize_dynamic(
+                _PooledEncoder(encoder).cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+            )
+            _save_atomic(lambda tmp: torch.save(quantized, tmp), path)
+        self.device = torch.device("cpu")
+        self.encoder = quantized.eval()
+
+
+class OnnxBackend:
+    """The encoder exported to ONNX and run by ONNX Runtime on CPU."""
+
+    def __init__(self, encoder, cache_prefix, device):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("the 'onnx' inference backend needs the onnxruntime package")
+        path = f"{cache_prefix}.onnx"
+        if not os.path.isfile(path):
+            _save_atomic(lambda tmp: self._export(encoder, tmp), path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.device = torch.device("cpu")
+        self.path = path
+
+    @staticmethod
+    def _export(encoder, path):
+        sample = torch.ones((1, 8), dtype=torch.long)
+        names = ["input_ids", "attention_mask", "token_type_ids"]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+        dynamic_axes["pooled"] = {0: "batch"}
+        torch.onnx.export(
+            _PooledEncoder(encoder).cpu().eval(),
+            (sample, sample, torch.zeros_like(sample)),
+            path,
+            input_names=names,
+            output_names=["pooled"],
+            dynamic_axes=dynamic_axes,
+            opset_version=17,
+        )
+
+    def __call__(self, inputs):
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        return torch.from_numpy(self.session.run(["pooled"], feed)[0])
+
+    def memory_footprint(self):
+        return os.path.getsize(self.path)
+
+
+BACKENDS = {
+    "eager": EagerBackend,
+    "int8": DynamicInt8Backend,
+    "onnx": OnnxBackend,
+}
+
+
+def load_backend(name, encoder, cache_prefix, device):
+    """Build the inference backend `name` for a BertModel encoder.
+
+    Converted encoders (quantized, exported) are cached on disk as
+    `<cache_prefix>.<ext>`; the prefix should identify the weights.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name](encoder, cache_prefix, device)
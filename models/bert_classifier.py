@@ -1,18 +1,25 @@
-from transformers import BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizerFast, BertForSequenceClassification
+import os
 import torch
+from models.backends import load_backend
+from utils.fingerprint import model_fingerprint
 
 class BertClassifier:
-    def __init__(self, model_path):
-        self.tokenizer = BertTokenizer.from_pretrained(model_path)
-        self.model = BertForSequenceClassification.from_pretrained(model_path)
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model.to(self.device)
-        self.model.eval()
+    def __init__(self, model_path, backend='eager', cache_dir=None):
+        self.tokenizer = BertTokenizerFast.from_pretrained(model_path)
+        model = BertForSequenceClassification.from_pretrained(model_path)
+        model.eval()
+        cache_prefix = os.path.join(
+            cache_dir or os.path.dirname(os.path.abspath(model_path)), model_fingerprint(model_path)
+        )
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.backend = load_backend(backend, model.bert, cache_prefix, device)
+        self.device = self.backend.device
+        self.classifier = model.classifier.to(self.device)
 
     def predict(self, text):
         inputs = self.tokenizer(text, return_tensors='pt', padding=True, truncation=True)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        pooled = self.backend(inputs)
         with torch.no_grad():
-            outputs = self.model(**inputs)
-            logits = outputs.logits
+            logits = self.classifier(pooled.to(self.device))
             return logits[0]
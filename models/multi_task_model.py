@@ -0,0 +1,38 @@
+import torch
+from models.sentiment_model import SentimentModel
+from utils.fingerprint import model_fingerprint
+from utils.theme_mapping import ThemeMapping
+
+
+class MultiTaskModel(SentimentModel):
+    """SentimentModel with main- and sub-theme heads on the same encoder.
+
+    `heads_path` is a torch state dict with `main_theme.weight/bias` and
+    `sub_theme.weight/bias`, linear layers over the pooled encoder output
+    sized to the themes in the `theme_mapping_path` Excel file.
+    """
+
+    def __init__(self, model_path, label_path, heads_path, theme_mapping_path, backend='eager', cache_dir=None):
+        super().__init__(model_path, label_path, backend=backend, cache_dir=cache_dir)
+        self.theme_mapping = ThemeMapping(theme_mapping_path)
+        state = torch.load(heads_path, map_location='cpu', weights_only=True)
+        hidden = self.classifier.in_features
+        sizes = {'main_theme': self.theme_mapping.num_main, 'sub_theme': self.theme_mapping.num_sub}
+        # theme predictions depend on the heads and mapping as well as the encoder
+        theme_fingerprint = model_fingerprint(
+            heads_path, theme_mapping_path, extra=(self.fingerprint,)
+        )
+        for name, size in sizes.items():
+            head = torch.nn.Linear(hidden, size)
+            head.load_state_dict(
+                {'weight': state[f'{name}.weight'], 'bias': state[f'{name}.bias']}
+            )
+            self.heads[name] = head.to(self.device).eval()
+            self.fingerprints[name] = theme_fingerprint
+
+    def _decode(self, type, ids):
+        if type == 'main_theme':
+            return self.theme_mapping.get_main_names(ids)
+        if type == 'sub_theme':
+            return self.theme_mapping.get_sub_names(ids)
+        return super()._decode(type, ids)
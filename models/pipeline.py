@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class InferencePipeline:
+    """Overlaps input preparation and tokenization with model inference.
+
+    A background thread pulls jobs, tokenizes them into padded batches and
+    queues them. The calling thread runs each batch through the model. The
+    queue holds at most `depth` batches, so a slow model applies backpressure
+    to the producer. Torch and the fast tokenizer both release the GIL, so the
+    two stages really do run at the same time.
+
+    After a run, `stats` holds the seconds each stage was busy, the seconds
+    each side spent waiting on the other, and how much they overlapped.
+    With a `profiler` (utils.profiling.TaskProfiler) the background thread
+    is profiled too.
+    """
+
+    def __init__(self, model, max_tokens=8192, depth=4, profiler=None):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.depth = depth
+        self.profiler = profiler
+        self.stats = {}
+
+    def run(self, jobs, on_batch=None):
+        """Predict every job and yield (job, labels) in the order the jobs came in.
+
+        `jobs` yields (job, texts) pairs and is consumed on the background
+        thread, so any reading or lookups it does overlap inference too.
+        `on_batch(job, done, todo)` is called after each batch of a job.
+        """
+        stats = self.stats = {
+            "read": 0.0,
+            "tokenize": 0.0,
+            "inference": 0.0,
+            "decode": 0.0,
+            "producer_blocked": 0.0,
+            "consumer_starved": 0.0,
+            "batches": 0,
+            "rows": 0,
+        }
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            stats["producer_blocked"] += time.perf_counter() - start
+
+        def produce():
+            try:
+                jobs_iter = iter(jobs)
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    job, texts = next(jobs_iter, (_END, None))
+                    stats["read"] += time.perf_counter() - start
+                    if job is _END:
+                        break
+                    put(("job", job, len(texts)))
+                    encoded = self.model.encode_batches(texts, self.max_tokens)
+                    while not stop.is_set():
+                        start = time.perf_counter()
+                        batch = next(encoded, None)
+                        stats["tokenize"] += time.perf_counter() - start
+                        if batch is None:
+                            break
+                        put(("batch",) + batch)
+                    put(("end", job, None))
+                put((_END, None, None))
+            except BaseException as e:
+                put(("error", e, None))
+
+        if self.profiler:
+            produce = self.profiler.wrap(produce)
+        producer = threading.Thread(target=produce, name="inference-pipeline", daemon=True)
+        wall = time.perf_counter()
+        producer.start()
+        try:
+            labels = done = None
+            while True:
+                start = time.perf_counter()
+                kind, first, second = batches.get()
+                stats["consumer_starved"] += time.perf_counter() - start
+                if kind is _END:
+                    break
+                elif kind == "error":
+                    raise first
+                elif kind == "job":
+                    job, todo = first, second
+                    labels = [None] * todo
+                    done = 0
+                elif kind == "batch":
+                    start = time.perf_counter()
+                    ids = self.model.predict_ids(second)
+                    decoded = time.perf_counter()
+                    predicted = self.model.decode_ids(ids)
+                    stats["inference"] += decoded - start
+                    stats["decode"] += time.perf_counter() - decoded
+                    for idx, label in zip(first, predicted):
+                        labels[idx] = label
+                    done += len(first)
+                    stats["batches"] += 1
+                    if on_batch:
+                        on_batch(job, done, todo)
+                else:
+                    stats["rows"] += len(labels)
+                    yield job, labels
+        finally:
+            stop.set()
+            producer.join()
+            stats["wall"] = time.perf_counter() - wall
+            busy = stats["read"] + stats["tokenize"] + stats["inference"] + stats["decode"]
+            stats["overlap"] = max(0.0, busy - stats["wall"])
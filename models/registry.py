@@ -0,0 +1,134 @@
+import logging
+import os
+import resource
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no procfs (e.g. macOS): fall back to the peak rss
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def memory_usage():
+    """This process's rss, pss (shared pages split between their users) and
+    private bytes; without smaps_rollup, only rss."""
+    usage = {"rss": _rss_bytes(), "pss": None, "private": None}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return usage
+    kb = lambda key: int(fields.get(key, "0 kB").split()[0]) * 1024
+    usage["pss"] = kb("Pss")
+    usage["private"] = kb("Private_Clean") + kb("Private_Dirty")
+    return usage
+
+
+class ModelRegistry:
+    """Loads each registered model once per process and hands out the shared instance.
+
+    A model registered with a `version` function is reloaded by `refresh`
+    when that version changes.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._models = {}
+        self._stats = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory, warmup=None, version=None):
+        self._factories[name] = (factory, warmup, version)
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is None:
+            with self._lock:
+                model = self._models.get(name)
+                if model is None:
+                    model = self._load(name)
+        return model
+
+    def load_all(self, warmup=True):
+        """Load every model. With `warmup`, models loaded without it (e.g. in
+        the parent of a prefork pool) are warmed up now."""
+        for name in self._factories:
+            with self._lock:
+                if name not in self._models:
+                    self._load(name, warmup)
+                elif warmup and self._stats[name]["warmup_time"] is None:
+                    # per process: the warmup allocates this process's own buffers
+                    self._stats[name]["warmup_time"] = self._warmup(name, self._models[name])
+
+    def refresh(self, name, min_interval=0):
+        """Reload `name` if its version changed; returns whether it did.
+
+        Checks at most every `min_interval` seconds. The new model replaces
+        the old one only once it is loaded and warmed up, and callers still
+        holding the old one finish with it. If loading fails, the old model
+        stays.
+        """
+        _, _, version = self._factories[name]
+        now = time.monotonic()
+        if version is None or name not in self._models:
+            return False
+        if now - self._checked.get(name, float("-inf")) < min_interval:
+            return False
+        self._checked[name] = now
+        if version() == self._stats[name]["version"]:
+            return False
+        with self._lock:
+            old = self._stats[name]["version"]
+            if version() == old:
+                return False
+            try:
+                self._load(name)
+            except Exception:
+                logger.exception("could not reload model %s, keeping the loaded one", name)
+                return False
+        logger.info("reloaded model %s: %s -> %s", name, old, self._stats[name]["version"])
+        return True
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def stats(self):
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def _warmup(self, name, model):
+        _, warmup, _ = self._factories[name]
+        if not warmup:
+            return None
+        start = time.perf_counter()
+        warmup(model)
+        return time.perf_counter() - start
+
+    def _load(self, name, warmup=True):
+        factory, _, version = self._factories[name]
+        rss_before = _rss_bytes()
+        # read before loading, so a change during the load is seen next time
+        loaded_version = version() if version else None
+        start = time.perf_counter()
+        model = factory()
+        load_time = time.perf_counter() - start
+        warmup_time = self._warmup(name, model) if warmup else None
+        self._stats[name] = {
+            "version": loaded_version,
+            "load_time": load_time,
+            "warmup_time": warmup_time,
+            "rss_delta_bytes": _rss_bytes() - rss_before,
+            "model_bytes": model.memory_footprint() if hasattr(model, "memory_footprint") else None,
+            "loaded_at": time.time(),
+            "pid": os.getpid(),
+        }
+        self._models[name] = model
+        return model
@@ -1,22 +1,160 @@
-from transformers import BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizerFast, BertForSequenceClassification
+import os
 import torch
 import pickle
+from models.backends import load_backend
+from utils.fingerprint import model_fingerprint
 
 class SentimentModel:
-    def __init__(self, model_path, label_path):
-        self.tokenizer = BertTokenizer.from_pretrained(model_path)
-        self.model = BertForSequenceClassification.from_pretrained(model_path)
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model.to(self.device)
-        self.model.eval()
+    def __init__(self, model_path, label_path, backend='eager', cache_dir=None):
+        # rust-backed tokenizer; releases the GIL while encoding
+        self.tokenizer = BertTokenizerFast.from_pretrained(model_path)
+        model = BertForSequenceClassification.from_pretrained(model_path)
+        model.eval()
         with open(label_path, 'rb') as f:
             self.label_encoder = pickle.load(f)
+        # converted encoders are cached per weights, predictions per weights + backend
+        cache_prefix = os.path.join(
+            cache_dir or os.path.dirname(os.path.abspath(model_path)), model_fingerprint(model_path)
+        )
+        self.fingerprint = model_fingerprint(model_path, label_path, extra=(backend,))
+        self.backend_name = backend
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.backend = load_backend(backend, model.bert, cache_prefix, device)
+        self.device = self.backend.device
+        self.classifier = model.classifier.to(self.device)
+        # every head reads the same pooled encoder output
+        self.heads = {'sentiment': self.classifier}
+        self.fingerprints = {'sentiment': self.fingerprint}
+
+    def memory_footprint(self):
+        """Bytes held by the encoder backend and the classification head."""
+        heads = sum(
+            p.numel() * p.element_size()
+            for head in self.heads.values()
+            for p in head.parameters()
+        )
+        return self.backend.memory_footprint() + heads
 
     def predict(self, text):
-        inputs = self.tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        return self.predict_batch([text])[0]
+
+    def predict_batch(
+        self, texts, max_tokens=8192, max_length=512, callback=None, types=None, confidence=False
+    ):
+        """Classify many texts at once, returning labels in the order of `texts`.
+
+        `callback(done)` is called after every batch. With `types`, each label
+        is a tuple with one prediction per type, see predict_encoded. With
+        `confidence`, each prediction is a (label, probability) pair.
+        """
+        labels = [None] * len(texts)
+        done = 0
+        for batch, inputs in self.encode_batches(texts, max_tokens, max_length):
+            for idx, label in zip(batch, self.predict_encoded(inputs, types, confidence)):
+                labels[idx] = label
+            done += len(batch)
+            if callback:
+                callback(done)
+        return labels
+
+    def encode_batches(self, texts, max_tokens=8192, max_length=512):
+        """Tokenize `texts` and yield (row indices, padded inputs) batches.
+
+        Rows are sorted by token length so each batch holds rows of similar
+        length, and a batch grows until its padded size would exceed
+        `max_tokens`.
+        """
+        texts = list(texts)
+        if not texts:
+            return
+        encodings = self.tokenizer(texts, truncation=True, max_length=max_length)
+        lengths = [len(ids) for ids in encodings['input_ids']]
+        order = sorted(range(len(lengths)), key=lengths.__getitem__)
+        batch = []
+        for idx in order:
+            # ascending order, so the newest row sets the padded length
+            if batch and (len(batch) + 1) * lengths[idx] > max_tokens:
+                yield batch, self._pad(encodings, batch, lengths[batch[-1]])
+                batch = []
+            batch.append(idx)
+        if batch:
+            yield batch, self._pad(encodings, batch, lengths[batch[-1]])
+
+    def _pad(self, encodings, batch, width):
+        pad_values = {'input_ids': self.tokenizer.pad_token_id}
+        inputs = {}
+        for key, rows in encodings.items():
+            pad = pad_values.get(key, 0)
+            inputs[key] = torch.tensor(
+                [rows[i] + [pad] * (width - len(rows[i])) for i in batch], dtype=torch.long
+            )
+        return inputs
+
+    def predict_encoded(self, inputs, types=None, confidence=False):
+        """Labels for one padded batch from encode_batches.
+
+        Without `types` these are sentiment labels. With `types`, the encoder
+        still runs once and each row gets a tuple of one label per type, so
+        every extra type only costs its linear head.
+        """
+        return self.decode_ids(self.predict_ids(inputs, types), types, confidence)
+
+    def predict_ids(self, inputs, types=None):
+        """(class ids, probabilities) per type for one padded batch; decode_ids
+        turns them into labels."""
+        pooled = self.backend(inputs)
+        return [self._argmax(t, pooled) for t in types or ('sentiment',)]
+
+    def decode_ids(self, ids, types=None, confidence=False):
+        decoded = []
+        for t, (type_ids, probabilities) in zip(types or ('sentiment',), ids):
+            labels = self._decode(t, type_ids)
+            decoded.append(list(zip(labels, probabilities.tolist())) if confidence else labels)
+        if types is None:
+            return decoded[0]
+        return list(zip(*decoded))
+
+    def _argmax(self, type, pooled):
+        """Predicted class ids and their softmax probability (the model's confidence)."""
         with torch.no_grad():
-            outputs = self.model(**inputs)
-        logits = outputs.logits
-        predicted_class = torch.argmax(logits, dim=-1).item()
-        return self.label_encoder.inverse_transform([predicted_class])[0]
+            logits = self.heads[type](pooled.to(self.device))
+            probabilities, ids = torch.softmax(logits, dim=-1).max(dim=-1)
+        return ids.cpu().numpy(), probabilities.float().cpu().numpy()
+
+    def _decode(self, type, ids):
+        return list(self.label_encoder.inverse_transform(ids))
+
+    def heads_for(self, types, confidence=False):
+        """This model restricted to `types`, for InferencePipeline; with
+        `confidence`, predicting (label, probability) pairs."""
+        for type in types:
+            if type not in self.heads:
+                raise ValueError(f"Model has no '{type}' head, expected one of {sorted(self.heads)}")
+        return _HeadSelection(self, tuple(types), confidence)
+
+
+class _HeadSelection:
+    """Predicts a fixed tuple of types per row with a shared encoder pass."""
+
+    def __init__(self, model, types, confidence=False):
+        self.model = model
+        self.types = types
+        self.confidence = confidence
+
+    def encode_batches(self, texts, max_tokens=8192, max_length=512):
+        return self.model.encode_batches(texts, max_tokens, max_length)
+
+    def predict_encoded(self, inputs):
+        return self.model.predict_encoded(inputs, self.types, self.confidence)
+
+    def predict_ids(self, inputs):
+        return self.model.predict_ids(inputs, self.types)
+
+    def decode_ids(self, ids):
+        return self.model.decode_ids(ids, self.types, self.confidence)
+
+    def predict_batch(self, texts, max_tokens=8192, max_length=512, callback=None):
+        return self.model.predict_batch(
+            texts, max_tokens, max_length, callback, self.types, self.confidence
+        )
@@ -1,52 +1,640 @@
-from celery import Celery
+from celery import Celery, chord
+from kombu import Queue
+from celery.exceptions import Ignore
+from celery.signals import (
+    task_failure,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+)
+from celery.utils.log import get_task_logger
 from .file_service import FileService
-from models.sentiment_model import SentimentModel
+from .job_queues import DEFAULT_QUEUE, JOB_CLASSES, queue_name
+from .prediction_cache import PredictionCache, normalize_comment
+from .progress_events import ProgressEvents
+from .storage_manager import StorageManager
+from models.pipeline import InferencePipeline
+from models.registry import ModelRegistry, memory_usage
+from utils import metrics
 from utils.config import Config
+from utils.fingerprint import combined_fingerprint
+from utils.profiling import TaskProfiler
+from utils.progress import ProgressReporter
+from utils.result_summary import ResultSummary
+import collections
+import gc
 import os
+import random
+import sqlite3
+import time
+
+logger = get_task_logger(__name__)
 
 # Celery configuration
 celery = Celery(
     __name__, broker=Config.CELERY_BROKER_URL, backend=Config.CELERY_RESULT_BACKEND
 )
+# unacked (acks_late) tasks are redelivered after this long, so it must exceed
+# the longest expected run time
+celery.conf.broker_transport_options = {
+    "visibility_timeout": Config.CELERY_VISIBILITY_TIMEOUT
+}
+
+# one queue per job cost class, so small files never wait behind big ones;
+# a worker started without -Q consumes all of them in turn
+celery.conf.task_queues = [Queue(DEFAULT_QUEUE)] + [Queue(queue_name(c)) for c in JOB_CLASSES]
+celery.conf.task_default_queue = DEFAULT_QUEUE
+celery.conf.worker_prefetch_multiplier = Config.CELERY_PREFETCH_MULTIPLIER
+
+# periodic maintenance, run by `celery beat`
+celery.conf.beat_schedule = {
+    "storage-maintenance": {
+        "task": f"{__name__}.storage_maintenance_task",
+        "schedule": Config.STORAGE_CHECK_INTERVAL,
+    }
+}
+
+progress_events = ProgressEvents(Config.PROGRESS_EVENTS_URL, Config.PROGRESS_EVENTS_CHANNEL)
+
+
+# output columns, in order, for every classification type a task can ask for
+CLASSIFICATION_TYPES = ("sentiment", "main_theme", "sub_theme")
+
+
+def _load_sentiment_model():
+    # read before loading, so a redeploy during the load is not published as loaded
+    version = FileService.model_version()
+    # imported here so that importing this module (e.g. from the API process)
+    # never pulls in torch/transformers
+    if Config.THEME_HEADS_PATH:
+        # theme heads share the sentiment encoder, so one pass serves every type
+        from models.multi_task_model import MultiTaskModel
+
+        model = MultiTaskModel(
+            Config.MODEL_PATH,
+            Config.LABEL_PATH,
+            Config.THEME_HEADS_PATH,
+            Config.THEME_MAPPING_PATH,
+            backend=Config.SENTIMENT_BACKEND,
+            cache_dir=Config.BACKEND_CACHE_DIR,
+        )
+    else:
+        from models.sentiment_model import SentimentModel
+
+        model = SentimentModel(
+            Config.MODEL_PATH,
+            Config.LABEL_PATH,
+            backend=Config.SENTIMENT_BACKEND,
+            cache_dir=Config.BACKEND_CACHE_DIR,
+        )
+    # the API keys new uploads with the model the workers run. Not through
+    # get_service(): this may run in the main worker process before it forks
+    try:
+        FileService(Config.UPLOAD_FOLDER, Config.OUTPUT_FOLDER).publish_fingerprints(
+            model.fingerprints, version
+        )
+    except sqlite3.Error:
+        logger.warning("could not publish the model fingerprints", exc_info=True)
+    return model
+
+
+# models are loaded once per worker process and shared by every task it runs;
+# a redeployed MODEL_PATH is picked up at the start of the next task
+registry = ModelRegistry()
+registry.register(
+    "sentiment",
+    _load_sentiment_model,
+    warmup=lambda model: model.predict("warmup"),
+    version=FileService.model_version,
+)
+
+# onnxruntime sessions and CUDA contexts do not survive a fork
+FORK_SAFE_BACKENDS = ("eager", "int8")
+
+
+@worker_init.connect
+def preload_models(sender=None, **kwargs):
+    """Load the weights in the main worker process, before the pool forks, so
+    the children share them copy-on-write instead of each loading a copy."""
+    if not Config.PRELOAD_MODELS or Config.SENTIMENT_BACKEND not in FORK_SAFE_BACKENDS:
+        return
+    import torch
+
+    if torch.cuda.is_available():
+        return
+    pool = getattr(sender, "pool_cls", None)
+    prefork = "prefork" in getattr(pool, "__module__", str(pool))
+    # no inference before the fork: the children set up their own thread pools
+    registry.load_all(warmup=not prefork)
+    # the collector would otherwise write to these objects in every child,
+    # unsharing their pages
+    gc.freeze()
+    logger.info("preloaded models before forking: %s", memory_usage())
+
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    # in the main worker process; prefork children report through PROMETHEUS_MULTIPROC_DIR
+    if Config.WORKER_METRICS_PORT:
+        metrics.start_exporter(Config.WORKER_METRICS_PORT)
+
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    metrics.mark_process_dead(pid or os.getpid())
+
+
+@worker_process_init.connect
+def load_models(**kwargs):
+    before = memory_usage()
+    registry.load_all()
+    after = memory_usage()
+    for kind, value in after.items():
+        if value is not None:
+            metrics.WORKER_MEMORY_BYTES.labels(kind).set(value)
+    logger.info("worker %d memory before models: %s, after: %s", os.getpid(), before, after)
+    for name, stats in registry.stats().items():
+        metrics.MODEL_LOAD_SECONDS.labels(name, "load").set(stats["load_time"])
+        metrics.MODEL_LOAD_SECONDS.labels(name, "warmup").set(stats["warmup_time"] or 0)
+        logger.info(
+            "loaded model %s in %.2fs (warmup %.2fs, %d MB weights, rss +%d MB)",
+            name,
+            stats["load_time"],
+            stats["warmup_time"] or 0,
+            (stats["model_bytes"] or 0) // 2**20,
+            stats["rss_delta_bytes"] // 2**20,
+        )
 
 
 class ClassificationService:
     def __init__(self):
+        self.pid = os.getpid()
         self.file_service = FileService(Config.UPLOAD_FOLDER, Config.OUTPUT_FOLDER)
-        self.sentiment_model = SentimentModel(Config.MODEL_PATH, Config.LABEL_PATH)
+        self.prediction_cache = PredictionCache(
+            Config.PREDICTION_CACHE_DB, Config.PREDICTION_CACHE_MAX_ENTRIES
+        )
+
+    def close(self):
+        self.file_service.db_service.close()
+        self.prediction_cache.close()
+
+    @property
+    def sentiment_model(self):
+        if Config.MODEL_SWAP_CHECK_INTERVAL > 0 and registry.refresh(
+            "sentiment", Config.MODEL_SWAP_CHECK_INTERVAL
+        ):
+            metrics.MODEL_SWAPS.inc()
+        return registry.get("sentiment")
+
+    def _model_for(self, fingerprint, types):
+        """(model, its fingerprint for `types`): the model this worker runs,
+        reloaded first if it does not match `fingerprint` and the files changed."""
+        model = self.sentiment_model
+        loaded = loaded_fingerprint(model, types)
+        if loaded != fingerprint and registry.refresh("sentiment"):
+            # the API has seen a redeploy this worker had not picked up yet
+            metrics.MODEL_SWAPS.inc()
+            model = registry.get("sentiment")
+            loaded = loaded_fingerprint(model, types)
+        return model, loaded
+
+    def resolve(self, unique_id):
+        """(model, output name) of `unique_id`'s task: the model is read once,
+        so the output is named after the model that makes it, and the name is
+        None if another upload already makes that result."""
+        result = self.file_service.get_result(unique_id)
+        if not result:
+            return self.sentiment_model, self.file_service.get_hash(unique_id)
+        fingerprint, types, output_name = result
+        model, loaded = self._model_for(fingerprint, types)
+        if loaded == fingerprint:
+            return model, output_name
+        # the model changed since the upload: the result is made with this one
+        producer, output_name = self.file_service.rekey_result(unique_id, loaded)
+        return model, None if producer else output_name
+
+    def shard_model(self, unique_id):
+        """The model for a shard of `unique_id`'s job: the one the job's result
+        was keyed to by its coordinator, so every shard is made by the same
+        model. Raises RuntimeError if this worker cannot load it anymore."""
+        result = self.file_service.get_result(unique_id)
+        if not result:
+            return self.sentiment_model
+        fingerprint, types, _ = result
+        model, loaded = self._model_for(fingerprint, types)
+        if loaded != fingerprint:
+            raise RuntimeError(f"the model of job {unique_id} was replaced while it ran")
+        return model
+
+
+def loaded_fingerprint(model, classification_types):
+    return combined_fingerprint({t: model.fingerprints.get(t) for t in classification_types})
+
+
+# like the models, one service (database connections and prediction cache) per
+# worker process, shared by every task it runs
+_service = None
+
+
+def get_service():
+    global _service
+    if _service is None or _service.pid != os.getpid():
+        # never a connection opened before a fork
+        _service = ClassificationService()
+    return _service
+
+
+@worker_process_init.connect
+def open_service(**kwargs):
+    get_service()
 
 
-@celery.task(bind=True)
-def classification_task(self, unique_id, classification_types=["sentiment"]):
+@worker_process_shutdown.connect
+def close_service(**kwargs):
+    if _service is not None and _service.pid == os.getpid():
+        _service.close()
+
+
+def output_columns(classification_types):
+    return ["comment"] + [t for t in CLASSIFICATION_TYPES if t in classification_types]
+
+
+def lookup_cached(cache, fingerprints, texts, classification_types):
+    """Look `texts` up in the prediction cache for every type in `classification_types`.
+
+    Returns (keys, labels, missing): a tuple of cache keys (one per type) for
+    every row, the (label, confidence) predictions found so far, and
+    {keys: normalized text} for each distinct comment the model still has to
+    see for at least one type.
+    """
+    keys = [
+        tuple(cache.make_key(text, fingerprints[t], t) for t in classification_types)
+        for text in texts
+    ]
+    labels = cache.get_many({key for row in keys for key in row})
+    missing = {}
+    for row, text in zip(keys, texts):
+        if row not in missing and any(key not in labels for key in row):
+            missing[row] = normalize_comment(text)
+    return keys, labels, missing
+
+
+def classify_rows(
+    task,
+    service,
+    sentiment_model,
+    unique_id,
+    file_path,
+    output_name,
+    classification_types,
+    total,
+    first_row=0,
+    header=True,
+    event=None,
+    profiler=None,
+    final=True,
+):
+    """Classify `total` rows of `file_path`, starting at `first_row`, into
+    `output_name` with `sentiment_model`.
+
+    Output is streamed to a .part file and checkpointed after every chunk
+    under the task's id, together with the label counts so far, so a re-run
+    of the same task resumes where the last one stopped. When `final`, the
+    counts become the result's summary; otherwise (a shard) the last
+    checkpoint is kept for merge_shards_task. `event` is merged into the
+    progress events published for `unique_id`. A `profiler` is stepped after
+    every inference batch.
+    """
+    file_service = service.file_service
+    columns = output_columns(classification_types)
+    types = tuple(columns[1:])
+    # one encoder pass per comment, whatever the number of types
+    model = sentiment_model.heads_for(types, confidence=True)
+    task_id = task.request.id or unique_id
+    checkpoint = file_service.get_checkpoint(task_id)
+    if (
+        checkpoint
+        # checkpoints from before summaries were kept start over
+        and checkpoint[2].rows == checkpoint[0]
+        and file_service.resume_classified_data(output_name, checkpoint[1])
+    ):
+        done, _, summary = checkpoint
+        logger.info("resuming task %s at row %d", task_id, done)
+    else:
+        file_service.start_classified_data(output_name, columns, header=header)
+        done = 0
+        summary = ResultSummary()
+    progress = ProgressReporter(
+        task,
+        total,
+        start=done,
+        every_rows=Config.PROGRESS_EVERY_ROWS,
+        every_ms=Config.PROGRESS_EVERY_MS,
+        on_update=lambda meta: (
+            metrics.ROWS_PER_SECOND.set(meta["rows_per_sec"]),
+            progress_events.publish(unique_id, {"status": "Processing", **meta, **(event or {})}),
+        ),
+    )
+    progress.update(done, force=True)
+    cache = service.prediction_cache
+    pipeline = InferencePipeline(
+        model,
+        max_tokens=Config.BATCH_TOKEN_BUDGET,
+        depth=Config.PIPELINE_DEPTH,
+        profiler=profiler,
+    )
+
+    start_row = done
+
+    def jobs():
+        # runs on the pipeline thread, so reading and cache lookups overlap inference.
+        # keys already sent to the model by an earlier chunk may not be cached
+        # yet; they are resolved when their chunk is written
+        scheduled = collections.OrderedDict()
+        for comments in file_service.iter_comment_chunks(
+            file_path,
+            chunksize=Config.CSV_CHUNK_ROWS,
+            skip_rows=first_row + start_row,
+            max_rows=total - start_row,
+        ):
+            if not types:
+                yield (comments, None, None, {}), []
+                continue
+            keys, labels, missing = lookup_cached(
+                cache, sentiment_model.fingerprints, comments, types
+            )
+            for key in [key for key in missing if key in scheduled]:
+                del missing[key]
+            scheduled.update(dict.fromkeys(missing))
+            while len(scheduled) > 4 * Config.CSV_CHUNK_ROWS:
+                scheduled.popitem(last=False)
+            yield (comments, keys, labels, missing), list(missing.values())
+
+    def on_batch(job, chunk_done, todo):
+        # progress over the distinct uncached comments, scaled to rows
+        progress.update(done + chunk_done * len(job[0]) // todo)
+        if profiler:
+            profiler.step()
+
+    stages = metrics.StageTimer(pipeline.stats)
+    for (comments, keys, labels, missing), predicted in pipeline.run(jobs(), on_batch):
+        classified_data = {"comment": comments}
+        confidences = {}
+        if keys is not None:
+            new_labels = {
+                key: label
+                for row, row_labels in zip(missing, predicted)
+                for key, label in zip(row, row_labels)
+            }
+            cache.put_many(new_labels.items())
+            labels.update(new_labels)
+            late = {
+                row: text
+                for row, text in zip(keys, comments)
+                if any(key not in labels for key in row)
+            }
+            if late:
+                # counted when their chunk was looked up
+                labels.update(
+                    cache.get_many({key for row in late for key in row}, track_stats=False)
+                )
+                # evicted before we got to them: predict directly
+                late = {
+                    row: normalize_comment(text)
+                    for row, text in late.items()
+                    if any(key not in labels for key in row)
+                }
+                for row, row_labels in zip(late, model.predict_batch(list(late.values()))):
+                    labels.update(zip(row, row_labels))
+            for i, type in enumerate(types):
+                classified_data[type] = [labels[row[i]][0] for row in keys]
+                confidences[type] = [labels[row[i]][1] for row in keys]
+        start = time.perf_counter()
+        output_bytes = file_service.append_classified_data(classified_data, output_name)
+        stages.chunk_done(len(comments), time.perf_counter() - start)
+        done += len(comments)
+        summary.add(classified_data, confidences)
+        file_service.save_checkpoint(task_id, unique_id, done, output_bytes, summary)
+        progress.update(done)
+    metrics.ROWS_PER_SECOND.set(0)
+    logger.info("task %s pipeline stages: %s", task_id, pipeline.stats)
+    if profiler:
+        profiler.info.update(
+            task_id=task_id, classification_types=types, rows=done - start_row, stages=pipeline.stats
+        )
+
+    file_service.finish_classified_data(output_name)
+    if final:
+        file_service.save_summary(unique_id, summary)
+    return done
+
+
+def profiled_classify_rows(profile, file_service, output_name, *args, **kwargs):
+    """classify_rows(*args, **kwargs), profiled and saved for `output_name` if `profile`."""
+    if not profile:
+        return classify_rows(*args, **kwargs)
+    profiler = TaskProfiler(Config.PROFILE_TRACE_BATCHES)
+    with profiler:
+        done = classify_rows(*args, profiler=profiler, **kwargs)
+    profiler.save(file_service.profile_base_path(output_name))
+    logger.info("saved profile of %s", output_name)
+    return done
+
+
+def shard_task_id(unique_id, index):
+    return f"{unique_id}-shard-{index}"
+
+
+def shard_output_name(output_name, index):
+    return f"{output_name}.shard-{index}"
+
+
+# acks_late + reject_on_worker_lost re-queue a task whose worker dies mid-run,
+# and the checkpoints let the retry resume where it left off
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def classification_task(self, unique_id, classification_types=["sentiment"], profile=False):
     self.update_state(state="PENDING")
-    service = ClassificationService()
+    profile = profile or random.random() < Config.PROFILE_SAMPLE_RATE
+    service = get_service()
     file_service = service.file_service
-    sentiment_model = service.sentiment_model
 
     stored_filename = file_service.get_hash(unique_id)
     if not stored_filename:
         raise NameError("Cannot fetch hash file of task", unique_id)
     file_path = os.path.join(Config.UPLOAD_FOLDER, stored_filename)
-    comments = file_service.read_comments(file_path)
-    total = len(comments)
-    file_service.set_state(unique_id, "processing")
-    self.update_state(
-        state="PROCESSING",
-        meta={"current": 0, "total": total},
-    )
-    classified_data = []
-    for idx, comment in enumerate(comments):
-        result = {"comment": comment}
+    started = file_service.start_job(unique_id, Config.MAX_HEAVY_JOBS_PER_CLIENT)
+    if started is None:
+        # the client's other large jobs go first; back of the queue
+        metrics.HEAVY_JOBS_DEFERRED.inc()
+        raise self.retry(countdown=Config.HEAVY_JOB_RETRY_SECONDS, max_retries=None)
+    job_class, queue_wait = started
+    metrics.QUEUE_WAIT_SECONDS.labels(job_class or "unknown").observe(max(queue_wait, 0))
+    sentiment_model, output_name = service.resolve(unique_id)
+    if output_name is None:
+        logger.info("task %s: result already made with the current model", unique_id)
+        file_service.set_state(unique_id, "success")
+        progress_events.publish(unique_id, {"status": "Success"})
+        return None
+    total = file_service.count_comments(file_path, chunksize=Config.CSV_CHUNK_ROWS)
+
+    if total > Config.SHARD_THRESHOLD_ROWS:
+        # fan the rows out over the fleet; merge_shards_task finishes the upload
+        shard_rows = [
+            min(Config.SHARD_ROWS, total - start) for start in range(0, total, Config.SHARD_ROWS)
+        ]
         self.update_state(
             state="PROCESSING",
-            meta={"current": idx, "total": total},
+            meta={"current": 0, "total": total, "shards": len(shard_rows), "shard_rows": shard_rows},
         )
-        if "sentiment" in classification_types:
-            sentiment = sentiment_model.predict(comment)
-            result["sentiment"] = sentiment
+        # a redelivered coordinator must not start the shards twice
+        if self.AsyncResult(shard_task_id(unique_id, 0)).state == "PENDING":
+            shards = [
+                # a profile is kept per output, so only the first shard is profiled
+                classify_shard_task.si(
+                    unique_id,
+                    index,
+                    index * Config.SHARD_ROWS,
+                    rows,
+                    classification_types,
+                    profile and index == 0,
+                ).set(task_id=shard_task_id(unique_id, index), queue=queue_name("large"))
+                for index, rows in enumerate(shard_rows)
+            ]
+            chord(shards)(
+                merge_shards_task.si(unique_id, len(shard_rows), classification_types).set(
+                    queue=queue_name("large")
+                )
+            )
+        logger.info("task %s split into %d shards", unique_id, len(shard_rows))
+        # keep the PROCESSING meta above instead of a SUCCESS result
+        raise Ignore()
 
-        classified_data.append(result)
+    profiled_classify_rows(
+        profile,
+        file_service,
+        output_name,
+        self,
+        service,
+        sentiment_model,
+        unique_id,
+        file_path,
+        output_name,
+        classification_types,
+        total,
+    )
+    file_service.set_state(unique_id, "success")
+    progress_events.publish(unique_id, {"status": "Success"})
+    return output_name
+
+
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def classify_shard_task(
+    self,
+    unique_id,
+    index,
+    first_row,
+    row_count,
+    classification_types=["sentiment"],
+    profile=False,
+):
+    service = get_service()
+    file_path = os.path.join(Config.UPLOAD_FOLDER, service.file_service.get_hash(unique_id))
+    output_name = service.file_service.get_output_name(unique_id)
+    profiled_classify_rows(
+        profile,
+        service.file_service,
+        output_name,
+        self,
+        service,
+        service.shard_model(unique_id),
+        unique_id,
+        file_path,
+        shard_output_name(output_name, index),
+        classification_types,
+        row_count,
+        first_row=first_row,
+        header=False,
+        event={"shard": index},
+        final=False,
+    )
+    return index
 
-    file_service.save_classified_data(classified_data, stored_filename)
+
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def merge_shards_task(self, unique_id, shard_count, classification_types=["sentiment"]):
+    file_service = get_service().file_service
+    output_name = file_service.get_output_name(unique_id)
+    parts = [shard_output_name(output_name, index) for index in range(shard_count)]
+    file_service.merge_classified_data(output_name, parts, output_columns(classification_types))
+    summary, complete = file_service.get_summary(unique_id)
+    if not complete:
+        # the shards' last checkpoints add up to the whole file
+        file_service.save_summary(unique_id, summary)
     file_service.set_state(unique_id, "success")
-    return stored_filename
+    # only now: a merge redelivered before this point finds its parts again
+    file_service.remove_outputs(parts)
+    progress_events.publish(unique_id, {"status": "Success"})
+    return output_name
+
+
+@celery.task
+def storage_maintenance_task():
+    """Drop expired upload sessions, then evict files down to the storage quota."""
+    file_service = get_service().file_service
+    file_service.expire_upload_sessions(Config.UPLOAD_SESSION_TTL)
+    storage = StorageManager(
+        file_service,
+        Config.STORAGE_QUOTA_BYTES,
+        low_watermark=Config.STORAGE_LOW_WATERMARK,
+        min_age=Config.STORAGE_MIN_AGE,
+    )
+    return storage.evict()
+
+
+def queue_depths():
+    """{queue name: messages waiting} as reported by the broker."""
+    names = [queue.name for queue in celery.conf.task_queues or ()]
+    depths = {}
+    try:
+        with celery.connection_for_read() as connection:
+            channel = connection.default_channel
+            for name in names or [celery.conf.task_default_queue]:
+                depths[name] = channel.queue_declare(name, passive=True).message_count
+    except Exception as e:
+        # a scrape must not fail because the broker is down
+        logger.warning("could not read queue depths: %s", e)
+    return depths
+
+
+def sharded_progress(unique_id, meta):
+    """Progress meta of a sharded task summed over its shards; None if a shard failed."""
+    current = 0
+    rate = 0.0
+    elapsed = 0.0
+    for index, rows in enumerate(meta["shard_rows"]):
+        shard = classification_task.AsyncResult(shard_task_id(unique_id, index))
+        if shard.state == "SUCCESS":
+            current += rows
+        elif shard.state == "FAILURE":
+            return None
+        elif shard.state == "PROCESSING":
+            current += shard.info.get("current", 0)
+            rate += shard.info.get("rows_per_sec", 0)
+            elapsed = max(elapsed, shard.info.get("elapsed", 0))
+    return {
+        "current": current,
+        "total": meta["total"],
+        "shards": meta["shards"],
+        "elapsed": elapsed,
+        "rows_per_sec": round(rate, 1),
+        "eta": round((meta["total"] - current) / rate, 1) if rate > 0 else None,
+    }
+
+
+@task_failure.connect(sender=classification_task)
+@task_failure.connect(sender=classify_shard_task)
+@task_failure.connect(sender=merge_shards_task)
+def publish_failure(task_id=None, args=None, **kwargs):
+    unique_id = args[0] if args else task_id
+    get_service().file_service.set_state(unique_id, "failure")
+    progress_events.publish(unique_id, {"status": "FAILURE"})
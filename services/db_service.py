@@ -1,17 +1,67 @@
+import os
 import sqlite3
+import threading
 import time
 from werkzeug.utils import secure_filename
+from utils.metrics import timed_db_query
 
 
 class DBService:
-    def __init__(self, db_file="file_records.db"):
+    # version the migrations below bring the schema to
+    SCHEMA_VERSION = 11
+
+    def __init__(self, db_file="file_records.db", busy_timeout=5000, journal_mode="WAL"):
         self.db_file = db_file
+        self.busy_timeout = busy_timeout
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
         self._init_db()
 
+    @property
+    def conn(self):
+        """This thread's connection; sqlite connections must not be shared across threads."""
+        if self._pid != os.getpid():
+            # forked (e.g. a celery prefork child): never reuse the parent's connections
+            self._local = threading.local()
+            self._connections = []
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _connect(self):
+        # check_same_thread is off only so close() can reach every thread's connection
+        conn = sqlite3.connect(
+            self.db_file, timeout=self.busy_timeout / 1000, check_same_thread=False
+        )
+        # WAL lets readers and the writer run concurrently; with it, NORMAL sync
+        # is still safe against corruption and only fsyncs at checkpoints
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        # switching a new database to WAL does not wait for the busy timeout,
+        # so processes opening it together retry until one has switched it
+        deadline = time.monotonic() + self.busy_timeout / 1000
+        while True:
+            try:
+                conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+                break
+            except sqlite3.OperationalError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
     def _init_db(self):
         """Setup the database and table"""
-        conn = sqlite3.connect(self.db_file)
-        self.conn = conn
+        conn = self.conn
         # check version
         cursor = conn.cursor()
         cursor.executescript(
@@ -25,7 +75,20 @@ class DBService:
             """
         )
         conn.commit()
-        version = self.get_current_version()
+        if self.get_current_version() < self.SCHEMA_VERSION:
+            # one process migrates while the others (gunicorn workers, pool
+            # children starting together) wait for the write lock, then find
+            # the schema up to date
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._migrate(self.get_current_version())
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        self._load_states()
+
+    def _migrate(self, version):
         if version == 0:
             self.create_tables()
         else:
@@ -35,10 +98,43 @@ class DBService:
                 self.migrate_to_v2()
             if version < 3:
                 self.migrate_to_v3()
+        if version < 4:
+            self.migrate_to_v4()
+        if version < 5:
+            self.migrate_to_v5()
+        if version < 6:
+            self.migrate_to_v6()
+        if version < 7:
+            self.migrate_to_v7()
+        if version < 8:
+            self.migrate_to_v8()
+        if version < 9:
+            self.migrate_to_v9()
+        if version < 10:
+            self.migrate_to_v10()
+        if version < 11:
+            self.migrate_to_v11()
 
-    def create_tables(self):
+    def _run_script(self, script):
+        """executescript without its implicit COMMIT, so that a migration runs
+        inside the transaction _init_db holds."""
+        statement = ""
+        for line in script.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                self.conn.execute(statement)
+                statement = ""
+
+    def _load_states(self):
+        """Cache the static states lookup table."""
         cursor = self.conn.cursor()
-        cursor.executescript(
+        cursor.execute("SELECT state_name, state_id FROM states")
+        self.state_ids = dict(cursor.fetchall())
+        self.state_names = {v: k for k, v in self.state_ids.items()}
+        cursor.close()
+
+    def create_tables(self):
+        self._run_script(
             """
             -- create the lookup table
             CREATE TABLE IF NOT EXISTS states (
@@ -74,11 +170,180 @@ class DBService:
             UPDATE schema_version SET version = 3 WHERE id = 1;
             """
         )
-        self.conn.commit()
+
+    def migrate_to_v11(self):
+        self._run_script(
+            """
+            -- per-type fingerprints (JSON) of the model the workers last
+            -- loaded and the file_version of the files they loaded it from;
+            -- the API keys new uploads with them
+            CREATE TABLE IF NOT EXISTS models (
+                name TEXT PRIMARY KEY,
+                fingerprints TEXT NOT NULL,
+                version TEXT NOT NULL,
+                loaded_at REAL
+            );
+
+            -- update database version
+            UPDATE schema_version SET version = 11 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v10(self):
+        self._run_script(
+            """
+            -- running label counts (utils.result_summary) of the checkpointed
+            -- rows, and the final ones of a finished result
+            ALTER TABLE checkpoints ADD COLUMN summary TEXT;
+            ALTER TABLE results ADD COLUMN summary TEXT;
+
+            -- update database version
+            UPDATE schema_version SET version = 10 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v9(self):
+        self._run_script(
+            """
+            -- one result per input, model and requested types; uploads point
+            -- at the result they need and u_id is the upload producing it
+            CREATE TABLE IF NOT EXISTS results (
+                result_id INTEGER PRIMARY KEY,
+                hash_id INTEGER NOT NULL,
+                model_fingerprint TEXT NOT NULL,
+                classification_types TEXT NOT NULL,
+                output_name TEXT NOT NULL,
+                u_id TEXT,
+                created REAL,
+                FOREIGN KEY (hash_id) REFERENCES hashs(hash_id),
+                UNIQUE (hash_id, model_fingerprint, classification_types)
+            );
+            CREATE INDEX IF NOT EXISTS results_u_id ON results (u_id);
+            ALTER TABLE records ADD COLUMN result_id INTEGER REFERENCES results(result_id);
+
+            -- existing outputs are named by their hash and their model and
+            -- types are unknown: they keep serving their uploads, but never
+            -- match a new one
+            INSERT INTO results (hash_id, model_fingerprint, classification_types, output_name, u_id, created)
+            SELECT hashs.hash_id, 'legacy', '', hashs.hash,
+                (SELECT u_id FROM records WHERE records.hash_id = hashs.hash_id
+                 ORDER BY upload_time LIMIT 1),
+                (SELECT MIN(upload_time) FROM records WHERE records.hash_id = hashs.hash_id)
+            FROM hashs
+            WHERE EXISTS (SELECT 1 FROM records WHERE records.hash_id = hashs.hash_id);
+            UPDATE records SET result_id = (
+                SELECT result_id FROM results WHERE results.hash_id = records.hash_id
+            );
+
+            -- update database version
+            UPDATE schema_version SET version = 9 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v8(self):
+        self._run_script(
+            """
+            -- who uploaded a file, its cost class and when its task started,
+            -- for per-client limits and queue wait stats
+            ALTER TABLE records ADD COLUMN client TEXT;
+            ALTER TABLE records ADD COLUMN job_class TEXT;
+            ALTER TABLE records ADD COLUMN started_at REAL;
+            CREATE INDEX IF NOT EXISTS records_client_jobs
+                ON records (client, job_class, state_id);
+
+            -- failed tasks no longer count as in flight
+            INSERT OR IGNORE INTO states (state_name) VALUES ('failure');
+
+            -- update database version
+            UPDATE schema_version SET version = 8 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v7(self):
+        self._run_script(
+            """
+            -- reference counts and last access for the storage manager
+            ALTER TABLE hashs ADD COLUMN ref_count INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE hashs ADD COLUMN last_access REAL;
+            UPDATE hashs SET
+                ref_count = (SELECT COUNT(*) FROM records WHERE records.hash_id = hashs.hash_id),
+                last_access = (SELECT MAX(upload_time) FROM records WHERE records.hash_id = hashs.hash_id);
+
+            -- keep the counts right whichever code path adds or removes records;
+            -- an upload counts as an access
+            CREATE TRIGGER IF NOT EXISTS records_ref_insert AFTER INSERT ON records
+            BEGIN
+                UPDATE hashs SET ref_count = ref_count + 1,
+                    last_access = MAX(COALESCE(last_access, 0), NEW.upload_time)
+                WHERE hash_id = NEW.hash_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_ref_delete AFTER DELETE ON records
+            BEGIN
+                UPDATE hashs SET ref_count = ref_count - 1 WHERE hash_id = OLD.hash_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_ref_update AFTER UPDATE OF hash_id ON records
+            BEGIN
+                UPDATE hashs SET ref_count = ref_count - 1 WHERE hash_id = OLD.hash_id;
+                UPDATE hashs SET ref_count = ref_count + 1 WHERE hash_id = NEW.hash_id;
+            END;
+
+            -- update database version
+            UPDATE schema_version SET version = 7 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v6(self):
+        self._run_script(
+            """
+            -- create the resumable upload table
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                upload_id TEXT PRIMARY KEY,
+                filename TEXT,
+                hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                received INTEGER NOT NULL DEFAULT 0,
+                classification_types TEXT,
+                update_time REAL
+            );
+
+            -- update database version
+            UPDATE schema_version SET version = 6 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v5(self):
+        self._run_script(
+            """
+            -- first upload of a hash, used by every status and download lookup
+            -- (hashs.hash needs no index of its own: UNIQUE already creates one)
+            CREATE INDEX IF NOT EXISTS records_hash_upload_time
+                ON records(hash_id, upload_time);
+
+            -- update database version
+            UPDATE schema_version SET version = 5 WHERE id = 1;
+            """
+        )
+
+    def migrate_to_v4(self):
+        self._run_script(
+            """
+            -- create the task checkpoint table
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                task_id TEXT PRIMARY KEY,
+                u_id TEXT,
+                row_offset INTEGER NOT NULL,
+                output_bytes INTEGER NOT NULL,
+                update_time REAL,
+                FOREIGN KEY (u_id) REFERENCES records(u_id) ON DELETE CASCADE
+            );
+
+            -- update database version
+            UPDATE schema_version SET version = 4 WHERE id = 1;
+            """
+        )
 
     def migrate_to_v3(self):
-        cursor = self.conn.cursor()
-        cursor.executescript(
+        self._run_script(
             """
             -- rename table
             ALTER TABLE IF EXISTS file_records RENAME TO records;
@@ -113,12 +378,9 @@ class DBService:
             UPDATE schema_version SET version = 3 WHERE id = 1;
             """
         )
-        self.conn.commit()
-        cursor.close()
 
     def migrate_to_v2(self):
-        cursor = self.conn.cursor()
-        cursor.executescript(
+        self._run_script(
             """
             -- create the lookup table
             CREATE TABLE IF NOT EXISTS states (
@@ -153,8 +415,6 @@ class DBService:
             UPDATE schema_version SET version = 2 WHERE id = 1;
             """
         )
-        self.conn.commit()
-        cursor.close()
 
     # def migrate_to_v1(self):
     #     cursor = self.conn.cursor()
@@ -177,42 +437,137 @@ class DBService:
         cursor.close()
         return version
 
-    def save_file_record(self, u_id, filename, hash_id, hash_value, size):
-        """Save a file's metadata in the database."""
-        cursor = self.conn.cursor()
-        if hash_id:
-            cursor.execute(
+    @timed_db_query
+    def save_upload(
+        self, u_id, filename, hash_value, size, model_fingerprint, classification_types, output_name
+    ):
+        """Record an upload together with the result it needs.
+
+        An earlier result is reused only if hash, model fingerprint and
+        classification types all match and the task producing it has not
+        failed; otherwise this upload's task produces it (taking over a
+        failed one). Returns the id of the upload producing the reused
+        result, or None if this upload's task has to run.
+        """
+        conn = self.conn
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO hashs (hash, size) VALUES (?, ?)", (hash_value, size))
+            (hash_id,) = conn.execute(
+                "SELECT hash_id FROM hashs WHERE hash = ?", (hash_value,)
+            ).fetchone()
+            row = conn.execute(
                 """
-                INSERT OR REPLACE INTO records (u_id, filename, upload_time, state_id, hash_id)
-                VALUES (
-                    ?, ?, ?,
-                    (SELECT state_id FROM states WHERE state_name = 'success'),
-                    ?
-                )
+                SELECT results.result_id, results.u_id, producer.state_id FROM results
+                LEFT JOIN records producer ON producer.u_id = results.u_id
+                WHERE results.hash_id = ? AND results.model_fingerprint = ?
+                AND results.classification_types = ?
                 """,
-                (u_id, filename, time.time(), hash_id),
-            )
-        else:
-            cursor.execute(
+                (hash_id, model_fingerprint, classification_types),
+            ).fetchone()
+            old_id = None
+            if row is None:
+                result_id = conn.execute(
+                    """
+                    INSERT INTO results (hash_id, model_fingerprint, classification_types,
+                        output_name, u_id, created)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (hash_id, model_fingerprint, classification_types, output_name, u_id, now),
+                ).lastrowid
+            elif row[2] is None or row[2] == self.state_ids["failure"]:
+                result_id = row[0]
+                conn.execute("UPDATE results SET u_id = ? WHERE result_id = ?", (u_id, result_id))
+            else:
+                result_id, old_id = row[0], row[1]
+            conn.execute(
                 """
-                INSERT OR REPLACE INTO hashs (hash, size)
-                VALUES (?, ?)
+                INSERT INTO records (u_id, filename, upload_time, state_id, hash_id, result_id)
+                VALUES (?, ?, ?, ?, ?, ?)
                 """,
-                (hash_value, size),
+                (
+                    u_id,
+                    filename,
+                    now,
+                    self.state_ids["success" if old_id else "pending"],
+                    hash_id,
+                    result_id,
+                ),
             )
-            cursor.execute(
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return old_id
+
+    @timed_db_query
+    def get_result(self, u_id):
+        """(model fingerprint, classification types, output name) of the result `u_id` needs."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT model_fingerprint, classification_types, output_name FROM results
+            INNER JOIN records ON records.result_id = results.result_id AND records.u_id = ?
+            """,
+            (u_id,),
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    @timed_db_query
+    def rekey_result(self, u_id, model_fingerprint, output_name):
+        """Re-key the result `u_id` needs to another model fingerprint.
+
+        If a result with the new key already exists and has not failed, the
+        uploads of this result move over to it and its producer's id is
+        returned: there is nothing left to do for `u_id`. Otherwise returns None.
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result_id, hash_id, classification_types = conn.execute(
                 """
-                INSERT OR REPLACE INTO records (u_id, filename, upload_time, state_id, hash_id)
-                VALUES (
-                    ?, ?, ?,
-                    (SELECT state_id FROM states WHERE state_name = 'pending'),
-                    (SELECT hash_id FROM hashs WHERE hash = ?)
-                )
+                SELECT results.result_id, results.hash_id, classification_types FROM results
+                INNER JOIN records ON records.result_id = results.result_id AND records.u_id = ?
                 """,
-                (u_id, filename, time.time(), hash_value),
-            )
-        self.conn.commit()
+                (u_id,),
+            ).fetchone()
+            other = conn.execute(
+                """
+                SELECT results.result_id, results.u_id, producer.state_id FROM results
+                LEFT JOIN records producer ON producer.u_id = results.u_id
+                WHERE results.hash_id = ? AND results.model_fingerprint = ?
+                AND results.classification_types = ?
+                """,
+                (hash_id, model_fingerprint, classification_types),
+            ).fetchone()
+            producer = None
+            if other and other[2] is not None and other[2] != self.state_ids["failure"]:
+                producer = other[1]
+                conn.execute(
+                    "UPDATE records SET result_id = ? WHERE result_id = ?", (other[0], result_id)
+                )
+                conn.execute("DELETE FROM results WHERE result_id = ?", (result_id,))
+            else:
+                if other:
+                    # a failed result with the new key: this one takes over its uploads
+                    conn.execute(
+                        "UPDATE records SET result_id = ? WHERE result_id = ?", (result_id, other[0])
+                    )
+                    conn.execute("DELETE FROM results WHERE result_id = ?", (other[0],))
+                conn.execute(
+                    "UPDATE results SET model_fingerprint = ?, output_name = ? WHERE result_id = ?",
+                    (model_fingerprint, output_name, result_id),
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return producer
 
+    @timed_db_query
     def check_hash(self, hash_value, size):
         cursor = self.conn.cursor()
         cursor.execute(
@@ -223,6 +578,7 @@ class DBService:
         cursor.close()
         return result[0] if result else None
 
+    @timed_db_query
     def get_filename(self, u_id):
         """Retrieve the filename from the database"""
         cursor = self.conn.cursor()
@@ -234,28 +590,102 @@ class DBService:
         cursor.close()
         return result[0] if result else None
 
+    @timed_db_query
     def get_file_state(self, u_id):
         cursor = self.conn.cursor()
-        cursor.execute(
-            """SELECT states.state_name FROM states INNER JOIN records 
-                ON states.state_id=records.state_id AND records.u_id = ?""",
-            (u_id,),
-        )
+        cursor.execute("SELECT state_id FROM records WHERE u_id = ?", (u_id,))
         result = cursor.fetchone()
         cursor.close()
-        return result[0] if result else None
+        return self.state_names.get(result[0]) if result else None
 
+    @timed_db_query
     def update_file_state(self, u_id, state):
+        state_id = self.state_ids.get(state)
+        if state_id is None:
+            return
         cursor = self.conn.cursor()
-        cursor.execute("SELECT state_id FROM states WHERE state_name = ?", (state,))
-        result = cursor.fetchone()
-        if result:
-            cursor.execute(
-                "UPDATE records SET state_id = ? WHERE u_id = ?",
-                (result[0], u_id),
-            )
+        cursor.execute(
+            "UPDATE records SET state_id = ? WHERE u_id = ?",
+            (state_id, u_id),
+        )
         self.conn.commit()
 
+    @timed_db_query
+    def set_job(self, u_id, client, job_class):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE records SET client = ?, job_class = ? WHERE u_id = ?",
+            (client, job_class, u_id),
+        )
+        self.conn.commit()
+
+    @timed_db_query
+    def start_job(self, u_id, heavy_limit):
+        """Mark an upload's task as processing, unless it is a large job and
+        its client already has `heavy_limit` large jobs processing (0: no limit).
+
+        Returns (job_class, seconds since the upload until the first start),
+        or None if the job has to wait.
+        """
+        conn = self.conn
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                """
+                UPDATE records SET state_id = ?, started_at = COALESCE(started_at, ?)
+                WHERE u_id = ? AND (
+                    ? = 0 OR job_class IS NOT 'large' OR client IS NULL OR (
+                        SELECT COUNT(*) FROM records other
+                        WHERE other.client = records.client AND other.job_class = 'large'
+                        AND other.state_id = ? AND other.u_id != records.u_id
+                    ) < ?
+                )
+                """,
+                (
+                    self.state_ids["processing"],
+                    now,
+                    u_id,
+                    heavy_limit,
+                    self.state_ids["processing"],
+                    heavy_limit,
+                ),
+            )
+            started = cursor.rowcount > 0
+            row = conn.execute(
+                "SELECT job_class, started_at - upload_time FROM records WHERE u_id = ?", (u_id,)
+            ).fetchone()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return row if started else None
+
+    @timed_db_query
+    def get_job_stats(self, since):
+        """{job_class: (pending jobs, [queue waits of jobs started since `since`])}."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT job_class, COUNT(*) FROM records
+            WHERE state_id = ? AND job_class IS NOT NULL GROUP BY job_class
+            """,
+            (self.state_ids["pending"],),
+        )
+        stats = {job_class: (count, []) for job_class, count in cursor.fetchall()}
+        cursor.execute(
+            """
+            SELECT job_class, started_at - upload_time FROM records
+            WHERE started_at >= ? AND job_class IS NOT NULL
+            """,
+            (since,),
+        )
+        for job_class, wait in cursor.fetchall():
+            stats.setdefault(job_class, (0, []))[1].append(wait)
+        cursor.close()
+        return stats
+
+    @timed_db_query
     def get_file_hash(self, u_id):
         cursor = self.conn.cursor()
         cursor.execute(
@@ -267,24 +697,259 @@ class DBService:
         cursor.close()
         return result[0] if result else None
 
-    def get_file_id(self, hash_value):
+    @timed_db_query
+    def get_status_info(self, u_id):
+        """Resolve an upload in one query.
+
+        Returns (original_id, state, hash, filename, output_name), where
+        original_id is the upload whose task produces this upload's result
+        (the one whose task does the work), or None if `u_id` is unknown.
+        """
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            SELECT records.u_id FROM records INNER JOIN hashs
-            ON records.hash_id = hashs.hash_id AND hashs.hash = ?
-            ORDER BY records.upload_time LIMIT 1
+            SELECT COALESCE(orig.u_id, r.u_id), COALESCE(orig.state_id, r.state_id),
+                hashs.hash, r.filename, COALESCE(results.output_name, hashs.hash)
+            FROM records r
+            LEFT JOIN hashs ON hashs.hash_id = r.hash_id
+            LEFT JOIN results ON results.result_id = r.result_id
+            LEFT JOIN records orig ON orig.u_id = results.u_id
+            WHERE r.u_id = ?
             """,
-            (hash_value,),
+            (u_id,),
         )
         result = cursor.fetchone()
         cursor.close()
-        return result[0] if result else None
+        if not result:
+            return None
+        original_id, state_id, hash_value, filename, output_name = result
+        return original_id, self.state_names.get(state_id), hash_value, filename, output_name
+
+    @timed_db_query
+    def save_checkpoint(self, task_id, u_id, row_offset, output_bytes, summary=None):
+        """Record that `row_offset` input rows are safely written to the partial
+        output, with the `summary` of those rows."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO checkpoints
+                (task_id, u_id, row_offset, output_bytes, update_time, summary)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (task_id, u_id, row_offset, output_bytes, time.time(), summary),
+        )
+        self.conn.commit()
+
+    @timed_db_query
+    def get_checkpoint(self, task_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT row_offset, output_bytes, summary FROM checkpoints WHERE task_id = ?",
+            (task_id,),
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    @timed_db_query
+    def save_summary(self, u_id, summary):
+        """Store the final summary of the result `u_id` made, dropping its checkpoints."""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                """
+                UPDATE results SET summary = ?
+                WHERE result_id = (SELECT result_id FROM records WHERE u_id = ?)
+                """,
+                (summary, u_id),
+            )
+            conn.execute("DELETE FROM checkpoints WHERE u_id = ?", (u_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    @timed_db_query
+    def get_summary(self, u_id):
+        """(final summary, checkpoint summaries) of the result `u_id` needs.
+
+        Until the result is finished the first is None and the second holds
+        the running summaries of its task (one per shard).
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT results.summary, COALESCE(results.u_id, records.u_id) FROM records
+            LEFT JOIN results ON results.result_id = records.result_id
+            WHERE records.u_id = ?
+            """,
+            (u_id,),
+        )
+        row = cursor.fetchone()
+        if not row or row[0]:
+            cursor.close()
+            return (row[0], []) if row else (None, [])
+        cursor.execute(
+            "SELECT summary FROM checkpoints WHERE u_id = ? AND summary IS NOT NULL", (row[1],)
+        )
+        summaries = [summary for (summary,) in cursor.fetchall()]
+        cursor.close()
+        return None, summaries
+
+    @timed_db_query
+    def save_model(self, name, fingerprints, version):
+        """Publish the fingerprints (JSON) of the model a process just loaded
+        from files at `version`."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO models (name, fingerprints, version, loaded_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (name, fingerprints, version, time.time()),
+        )
+        self.conn.commit()
+
+    @timed_db_query
+    def get_model(self, name):
+        """(fingerprints, version) last published for `name`, or None."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT fingerprints, version FROM models WHERE name = ?", (name,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    @timed_db_query
+    def delete_checkpoint(self, task_id):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM checkpoints WHERE task_id = ?", (task_id,))
+        self.conn.commit()
+
+    @timed_db_query
+    def save_upload_session(self, upload_id, filename, hash_value, size, classification_types):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO upload_sessions
+                (upload_id, filename, hash, size, received, classification_types, update_time)
+            VALUES (?, ?, ?, ?, 0, ?, ?)
+            """,
+            (upload_id, filename, hash_value, size, classification_types, time.time()),
+        )
+        self.conn.commit()
+
+    @timed_db_query
+    def get_upload_session(self, upload_id):
+        """(filename, hash, size, received, classification_types), or None."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT filename, hash, size, received, classification_types
+            FROM upload_sessions WHERE upload_id = ?
+            """,
+            (upload_id,),
+        )
+        result = cursor.fetchone()
+        cursor.close()
+        return result
+
+    @timed_db_query
+    def advance_upload_session(self, upload_id, received, new_received):
+        """Move a session from `received` to `new_received` bytes; False if another
+        request moved it first."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            UPDATE upload_sessions SET received = ?, update_time = ?
+            WHERE upload_id = ? AND received = ?
+            """,
+            (new_received, time.time(), upload_id, received),
+        )
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    @timed_db_query
+    def delete_upload_session(self, upload_id):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM upload_sessions WHERE upload_id = ?", (upload_id,))
+        self.conn.commit()
+
+    @timed_db_query
+    def expire_upload_sessions(self, before):
+        """Delete sessions untouched since `before`, returning their ids."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT upload_id FROM upload_sessions WHERE update_time < ?", (before,))
+        expired = [row[0] for row in cursor.fetchall()]
+        cursor.executemany(
+            "DELETE FROM upload_sessions WHERE upload_id = ?", [(i,) for i in expired]
+        )
+        self.conn.commit()
+        return expired
+
+    @timed_db_query
+    def touch_hash(self, hash_value):
+        cursor = self.conn.cursor()
+        cursor.execute("UPDATE hashs SET last_access = ? WHERE hash = ?", (time.time(), hash_value))
+        self.conn.commit()
+
+    @timed_db_query
+    def get_hash_usage(self):
+        """(hash, ref_count, last_access, in_flight) for every stored hash,
+        least recently used first."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT hash, ref_count, COALESCE(last_access, 0),
+                EXISTS (
+                    SELECT 1 FROM records WHERE records.hash_id = hashs.hash_id
+                    AND records.state_id IN (?, ?)
+                )
+            FROM hashs ORDER BY COALESCE(last_access, 0)
+            """,
+            (self.state_ids["pending"], self.state_ids["processing"]),
+        )
+        result = [(h, refs, last, bool(busy)) for h, refs, last, busy in cursor.fetchall()]
+        cursor.close()
+        return result
+
+    @timed_db_query
+    def delete_hash(self, hash_value, accessed_before):
+        """Forget a hash and every upload of it, unless it was accessed since
+        `accessed_before` or has a task in flight. Returns whether it did."""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                """
+                SELECT hash_id FROM hashs WHERE hash = ? AND COALESCE(last_access, 0) < ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM records WHERE records.hash_id = hashs.hash_id
+                    AND records.state_id IN (?, ?)
+                )
+                """,
+                (hash_value, accessed_before, self.state_ids["pending"], self.state_ids["processing"]),
+            )
+            row = cursor.fetchone()
+            if row:
+                conn.execute("DELETE FROM records WHERE hash_id = ?", row)
+                conn.execute("DELETE FROM results WHERE hash_id = ?", row)
+                conn.execute("DELETE FROM hashs WHERE hash_id = ?", row)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return row is not None
 
+    @timed_db_query
     def delete_record(self, u_id):
         cursor = self.conn.cursor()
         cursor.execute("DELETE FROM records WHERE u_id = ?", (u_id,))
         self.conn.commit()
 
     def close(self):
-        self.conn.close()
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
@@ -1,78 +1,537 @@
+import fcntl
+import glob
+import hashlib
+import json
 import os
+import shutil
+import threading
+import time
 import pandas as pd
 from werkzeug.utils import secure_filename
 from services.db_service import DBService
+from services.job_queues import job_class
+from services.output_formats import FORMATS
 import uuid
 from utils.hashing_file import HashingFile
+from utils import metrics
+from utils.config import Config
+from utils.fingerprint import combined_fingerprint, file_version
+from utils.profiling import FILES as PROFILE_FILES
+from utils.result_summary import ResultSummary
 
 
 class FileService:
-    def __init__(self, upload_folder, output_folder):
+    # states that never change again, so their status can be cached
+    TERMINAL_STATES = {"success"}
+    # locks shared by the artifact conversions of all outputs
+    ARTIFACT_LOCKS = 64
+
+    def __init__(self, upload_folder, output_folder, status_cache_ttl=30):
         self.db_service = DBService()
         self.upload_folder = upload_folder
         self.output_folder = output_folder
+        self.status_cache_ttl = status_cache_ttl
+        self._status_cache = {}
+        # upload_id -> (received, running sha256) of chunked uploads
+        self._upload_hashers = {}
+        # striped, so one conversion per artifact runs at a time without a
+        # lock per path ever served
+        self._artifact_locks = [threading.Lock() for _ in range(self.ARTIFACT_LOCKS)]
         os.makedirs(upload_folder, exist_ok=True)
         os.makedirs(output_folder, exist_ok=True)
 
-    def save_uploaded_file(self, file):
+    def save_uploaded_file(self, file, classification_types=("sentiment",)):
         filename = secure_filename(file.filename)
-        unique_id = str(uuid.uuid4())
-        stored_filename = f"{unique_id}"
-        file_path = os.path.join(self.upload_folder, stored_filename)
-
-        old_file = self.db_service.get_filename(unique_id)
-        if old_file:
-            self.db_service.delete_record(unique_id)
+        file_path = os.path.join(self.upload_folder, str(uuid.uuid4()))
 
+        start = time.perf_counter()
         destination = open(file_path, "wb")
         hashing_file = HashingFile(destination)
         file.save(hashing_file, buffer_size=64 * 1024)
         file.close()
-        hash_value = hashing_file.get_hash()
+        hashing_file.close()
+        metrics.observe_upload(os.path.getsize(file_path), time.perf_counter() - start)
+        return self._register_upload(
+            file_path, filename, hashing_file.get_hash(), classification_types
+        )
+
+    def _register_upload(self, file_path, filename, hash_value, classification_types):
+        """Store a fully received file under its hash and record the upload.
+
+        Returns (unique_id, old_id), where old_id is the upload whose task
+        already produces the same result (same content, model and types), if any.
+        """
+        unique_id = str(uuid.uuid4())
         hash_file_path = os.path.join(self.upload_folder, hash_value)
-        old_id = None
         if not os.path.isfile(hash_file_path):
             os.rename(file_path, hash_file_path)
         else:
             os.remove(file_path)
-            old_id = self.db_service.get_file_id(hash_value)
         size = os.path.getsize(hash_file_path)
-        hash_id = self.db_service.check_hash(hash_value, size)
-        self.db_service.save_file_record(unique_id, filename, hash_id, hash_value, size)
+        return unique_id, self._save_upload(
+            unique_id, filename, hash_value, size, classification_types
+        )
+
+    def register_known_upload(self, filename, hash_value, size, classification_types):
+        """Record an upload of content we already hold, without receiving it.
+
+        Returns (unique_id, old_id) as _register_upload does, or None if the
+        hash (at this size) is unknown and the file has to be uploaded.
+        """
+        hash_file_path = os.path.join(self.upload_folder, hash_value)
+        if not os.path.isfile(hash_file_path) or os.path.getsize(hash_file_path) != size:
+            return None
+        # touched first, so the storage manager leaves it alone from here on
+        self.db_service.touch_hash(hash_value)
+        if not self.db_service.check_hash(hash_value, size):
+            return None
+        unique_id = str(uuid.uuid4())
+        old_id = self._save_upload(
+            unique_id, secure_filename(filename), hash_value, size, classification_types
+        )
         return unique_id, old_id
 
-    def read_comments(self, file_path, column="comment"):
-        df = pd.read_csv(file_path)
-        if column not in df.columns:
+    def _save_upload(self, unique_id, filename, hash_value, size, classification_types):
+        types = sorted(set(classification_types))
+        fingerprint = self.current_fingerprint(types)
+        return self.db_service.save_upload(
+            unique_id,
+            filename,
+            hash_value,
+            size,
+            fingerprint,
+            ",".join(types),
+            self.output_name(hash_value, fingerprint, types),
+        )
+
+    def current_fingerprint(self, classification_types):
+        """Fingerprint of the model for `classification_types`: the
+        combined_fingerprint of the per-type fingerprints the workers published
+        when they loaded it (see models/), so adding theme heads leaves
+        sentiment results valid.
+
+        The API never reads the model itself, only the cheap model_version of
+        its files. If no worker has loaded those yet, uploads are keyed with
+        that version instead and their task re-keys the result to the model.
+        """
+        version = self.model_version()
+        published = self.db_service.get_model("sentiment")
+        if published and published[1] == version:
+            fingerprints = json.loads(published[0])
+        else:
+            fingerprints = {t: f"version:{version}" for t in classification_types}
+        return combined_fingerprint({t: fingerprints.get(t) for t in classification_types})
+
+    def publish_fingerprints(self, fingerprints, version):
+        """Called by a process that loaded the sentiment model from files at `version`."""
+        self.db_service.save_model("sentiment", json.dumps(fingerprints), version)
+
+    @staticmethod
+    def model_version():
+        """file_version of the sentiment model's files: it changes on any redeploy."""
+        paths = [Config.MODEL_PATH, Config.LABEL_PATH]
+        if Config.THEME_HEADS_PATH:
+            paths += [Config.THEME_HEADS_PATH, Config.THEME_MAPPING_PATH]
+        return file_version(paths)
+
+    @staticmethod
+    def output_name(hash_value, fingerprint, classification_types):
+        """Outputs are named after everything they depend on: input, model and types."""
+        return f"{hash_value}.{fingerprint[:16]}.{'-'.join(sorted(classification_types))}"
+
+    def _session_path(self, upload_id):
+        return os.path.join(self.upload_folder, f"{upload_id}.upload")
+
+    def create_upload_session(self, filename, hash_value, size, classification_types):
+        upload_id = str(uuid.uuid4())
+        open(self._session_path(upload_id), "wb").close()
+        self.db_service.save_upload_session(
+            upload_id, secure_filename(filename), hash_value.lower(), size, ",".join(classification_types)
+        )
+        return upload_id
+
+    def get_upload_session(self, upload_id):
+        """{filename, hash, size, received, classification_types}, or None."""
+        session = self.db_service.get_upload_session(upload_id)
+        if not session:
+            return None
+        filename, hash_value, size, received, classification_types = session
+        return {
+            "filename": filename,
+            "hash": hash_value,
+            "size": size,
+            "received": received,
+            "classification_types": classification_types.split(","),
+        }
+
+    def write_upload_chunk(self, upload_id, session, start, stop, stream):
+        """Write the chunk in `stream`, bytes `start` to `stop` (exclusive) of
+        an upload session.
+
+        Chunks of a session are written one at a time (under a lock on its
+        file, across processes), so the running SHA-256 kept by this process
+        always covers exactly the bytes on disk. Another process (or a
+        restart) picks it up by re-hashing the bytes received so far. Returns
+        the new received offset, or None if `start` is not the current offset
+        (the client should ask for it and resume from there). Raises
+        ValueError if the chunk is not exactly `stop - start` bytes long.
+        """
+        if start != session["received"]:
+            return None
+        path = self._session_path(upload_id)
+        started = time.perf_counter()
+        with open(path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # another request may have moved the session while this one waited
+            current = self.get_upload_session(upload_id)
+            if not current or start != current["received"]:
+                return None
+            hasher = self._upload_hashers.pop(upload_id, (None, None))
+            if hasher[0] != start:
+                hasher = (start, self._hash_prefix(path, start))
+            f.seek(start)
+            f.truncate()
+            hashing_file = HashingFile(f, hasher[1])
+            written = 0
+            for block in iter(lambda: stream.read(64 * 1024), b""):
+                written += len(block)
+                if start + written > stop:
+                    raise ValueError("Chunk is longer than its Content-Range")
+                hashing_file.write(block)
+            if start + written != stop:
+                raise ValueError("Chunk is shorter than its Content-Range")
+            f.flush()
+            os.fsync(f.fileno())
+            self.db_service.advance_upload_session(upload_id, start, stop)
+            self._upload_hashers[upload_id] = (stop, hashing_file.hash)
+        metrics.observe_upload(written, time.perf_counter() - started)
+        session["received"] = stop
+        return stop
+
+    @staticmethod
+    def _hash_prefix(path, length):
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            while length > 0:
+                block = f.read(min(length, 1024 * 1024))
+                if not block:
+                    break
+                hasher.update(block)
+                length -= len(block)
+        return hasher
+
+    def finish_upload(self, upload_id, session):
+        """Register a completely received upload; returns (unique_id, old_id),
+        or None if another request finished it first.
+
+        The session is kept until the file is verified and registered, so a
+        final request that timed out can be repeated. Raises ValueError, and
+        drops the session, if the file's size or SHA-256 does not match what
+        the client declared.
+        """
+        path = self._session_path(upload_id)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if not self.get_upload_session(upload_id):
+                return None
+            size = os.fstat(f.fileno()).st_size
+            received, hasher = self._upload_hashers.pop(upload_id, (None, None))
+            if size == session["size"] and received != size:
+                # the chunks went through another process
+                hasher = self._hash_prefix(path, size)
+            error = None
+            if size != session["size"]:
+                error = "Uploaded content does not match its size"
+            elif hasher.hexdigest() != session["hash"]:
+                error = "Uploaded content does not match its SHA-256"
+            if error:
+                self.db_service.delete_upload_session(upload_id)
+                os.remove(path)
+                raise ValueError(error)
+            registered = self._register_upload(
+                path, session["filename"], session["hash"], session["classification_types"]
+            )
+            self.db_service.delete_upload_session(upload_id)
+        return registered
+
+    def expire_upload_sessions(self, max_age):
+        for upload_id in self.db_service.expire_upload_sessions(time.time() - max_age):
+            self._upload_hashers.pop(upload_id, None)
+            path = self._session_path(upload_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def iter_comment_chunks(
+        self, file_path, column="comment", chunksize=10000, skip_rows=0, max_rows=None
+    ):
+        """Yield the comment column in lists of at most `chunksize` rows,
+        starting after the first `skip_rows` data rows."""
+        header = pd.read_csv(file_path, nrows=0)
+        if column not in header.columns:
             raise ValueError(f"CSV must have a '{column}' column")
-        return df[column].tolist()
+        reader = pd.read_csv(
+            file_path,
+            usecols=[column],
+            chunksize=chunksize,
+            skiprows=range(1, skip_rows + 1),
+            nrows=max_rows,
+        )
+        for chunk in reader:
+            yield chunk[column].tolist()
+
+    def count_comments(self, file_path, column="comment", chunksize=10000):
+        return sum(len(chunk) for chunk in self.iter_comment_chunks(file_path, column, chunksize))
+
+    def _partial_path(self, filename):
+        return os.path.join(self.output_folder, f"{filename}.part")
+
+    def start_classified_data(self, filename, columns, header=True):
+        """Begin a streamed output file; rows go to a .part file until finished."""
+        pd.DataFrame(columns=columns).to_csv(
+            self._partial_path(filename), index=False, header=header
+        )
+
+    def resume_classified_data(self, filename, size):
+        """Cut a partial output back to its last checkpointed `size`.
 
-    def save_classified_data(self, data, filename):
+        Returns False when the partial output is missing or shorter than that,
+        in which case the task has to start over.
+        """
+        path = self._partial_path(filename)
+        if not os.path.isfile(path) or os.path.getsize(path) < size:
+            return False
+        os.truncate(path, size)
+        return True
+
+    def append_classified_data(self, data, filename):
+        """Append rows to the partial output, returning its size once they are on disk."""
+        with open(self._partial_path(filename), "a", newline="") as f:
+            pd.DataFrame(data).to_csv(f, header=False, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+            return os.fstat(f.fileno()).st_size
+
+    def finish_classified_data(self, filename):
+        os.replace(self._partial_path(filename), os.path.join(self.output_folder, filename))
+        return filename
+
+    def merge_classified_data(self, filename, parts, columns):
+        """Concatenate finished outputs `parts` (without headers) into `filename`.
+
+        The parts are left for the caller to remove (remove_outputs) once it
+        has recorded the merge, so a merge that dies halfway can simply run
+        again; with the merged file in place and a part gone, it already ran.
+        """
         output_path = os.path.join(self.output_folder, filename)
-        df = pd.DataFrame(data)
-        df.to_csv(output_path, index=False)
+        if os.path.isfile(output_path) and not all(
+            os.path.isfile(os.path.join(self.output_folder, part)) for part in parts
+        ):
+            return filename
+        path = self._partial_path(filename)
+        with open(path, "w", newline="") as out:
+            pd.DataFrame(columns=columns).to_csv(out, index=False)
+            for part in parts:
+                with open(os.path.join(self.output_folder, part), "rb") as f:
+                    out.flush()
+                    shutil.copyfileobj(f, out.buffer, 1024 * 1024)
+            out.flush()
+            os.fsync(out.fileno())
+        self.finish_classified_data(filename)
         return filename
 
+    def remove_outputs(self, filenames):
+        for filename in filenames:
+            path = os.path.join(self.output_folder, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_output_artifact(self, filename, fmt):
+        """Path of output `filename` in format `fmt` (see services.output_formats).
+
+        Converted and compressed copies are built on first request and cached
+        next to the output as `<filename><suffix>`; they are rebuilt if the
+        output is newer.
+        """
+        output_path = os.path.join(self.output_folder, filename)
+        spec = FORMATS[fmt]
+        if spec["convert"] is None:
+            return output_path
+        path = output_path + spec["suffix"]
+        with self._artifact_locks[hash(path) % len(self._artifact_locks)]:
+            if not self._is_fresh(path, output_path):
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    spec["convert"](output_path, tmp_path)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        return path
+
+    @staticmethod
+    def _is_fresh(path, source):
+        try:
+            return os.path.getmtime(path) >= os.path.getmtime(source)
+        except FileNotFoundError:
+            return False
+
     def get_original_filename(self, unique_id):
         return self.db_service.get_filename(unique_id)
 
-    def delete_file(self, filename):
-        upload_file = os.path.join(self.upload_folder, filename)
-        output_file = os.path.join(self.output_folder, filename)
+    def delete_file(self, hash_value):
+        """Delete an upload and every output made from it, with their artifacts and profiles."""
+        upload_file = os.path.join(self.upload_folder, hash_value)
         if os.path.exists(upload_file):
             os.remove(upload_file)
-        if os.path.exists(output_file):
-            os.remove(output_file)
+        # outputs are named <hash>.<model>.<types>, or just <hash> for older ones
+        output_file = os.path.join(self.output_folder, hash_value)
+        for path in [output_file] + glob.glob(glob.escape(output_file) + ".*"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def profile_base_path(self, filename):
+        """Profiles of `filename` are kept next to its output (see utils.profiling)."""
+        return os.path.join(self.output_folder, filename)
+
+    def get_profile_file(self, filename, kind):
+        """Path of profile file `kind` of `filename`, or None if it was not profiled."""
+        path = self.profile_base_path(filename) + PROFILE_FILES[kind]
+        return path if os.path.isfile(path) else None
+
+    def touch(self, hash_value):
+        """Mark a hash as used now, for least-recently-used eviction."""
+        self.db_service.touch_hash(hash_value)
 
     def get_hash(self, u_id):
         return self.db_service.get_file_hash(u_id)
 
+    def get_output_name(self, u_id):
+        """Name of the output `u_id` gets, in the output folder."""
+        info = self.db_service.get_status_info(u_id)
+        return info[4] if info else None
+
+    def get_result(self, u_id):
+        """(model fingerprint, classification types, output name) of the result
+        `u_id` needs, or None."""
+        result = self.db_service.get_result(u_id)
+        if not result or not result[1]:
+            # none, or from before results were keyed (see DBService.migrate_to_v9)
+            return None
+        fingerprint, types, output_name = result
+        return fingerprint, types.split(","), output_name
+
+    def rekey_result(self, u_id, fingerprint):
+        """Key the result `u_id` needs to the model `fingerprint` it is actually
+        made with. Returns (producer, output name): producer is the upload whose
+        task already makes that result, or None if `u_id` still has to."""
+        _, types, _ = self.get_result(u_id)
+        output_name = self.output_name(self.get_hash(u_id), fingerprint, types)
+        return self.db_service.rekey_result(u_id, fingerprint, output_name), output_name
+
     def get_state(self, unique_id):
         return self.db_service.get_file_state(unique_id)
 
     def set_state(self, u_id, state):
         self.db_service.update_file_state(u_id, state)
 
+    @staticmethod
+    def estimate_rows(file_path, limit):
+        """Line count of `file_path` minus the header; counting stops above `limit`.
+
+        Comments with line breaks count more than once, which is fine for an estimate.
+        """
+        lines = 0
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                lines += block.count(b"\n")
+                if lines > limit:
+                    break
+        return max(lines - 1, 0)
+
+    def assign_job(self, u_id, client):
+        """Record who uploaded `u_id` and its cost class (see services.job_queues)."""
+        file_path = os.path.join(self.upload_folder, self.get_hash(u_id))
+        size = os.path.getsize(file_path)
+        rows = 0
+        if size <= Config.LARGE_JOB_BYTES:
+            # bigger files are large whatever their row count
+            rows = self.estimate_rows(file_path, Config.LARGE_JOB_ROWS)
+        job = job_class(rows, size)
+        self.db_service.set_job(u_id, client, job)
+        return job
+
+    def start_job(self, u_id, heavy_limit):
+        return self.db_service.start_job(u_id, heavy_limit)
+
+    def get_job_stats(self, since):
+        return self.db_service.get_job_stats(since)
+
+    def save_checkpoint(self, task_id, u_id, row_offset, output_bytes, summary=None):
+        self.db_service.save_checkpoint(
+            task_id, u_id, row_offset, output_bytes, summary and summary.to_json()
+        )
+
+    def get_checkpoint(self, task_id):
+        """(row_offset, output_bytes, ResultSummary of those rows), or None."""
+        checkpoint = self.db_service.get_checkpoint(task_id)
+        if not checkpoint:
+            return None
+        row_offset, output_bytes, summary = checkpoint
+        return row_offset, output_bytes, ResultSummary.from_json(summary)
+
+    def save_summary(self, u_id, summary):
+        """Store the final ResultSummary of the result `u_id` made (and drop its checkpoints)."""
+        self.db_service.save_summary(u_id, summary.to_json())
+
+    def get_summary(self, u_id):
+        """(ResultSummary, complete) of the result `u_id` needs. Until its task
+        has finished, the summary covers the rows checkpointed so far."""
+        final, partial = self.db_service.get_summary(u_id)
+        if final:
+            return ResultSummary.from_json(final), True
+        summary = ResultSummary()
+        for value in partial:
+            summary.merge(ResultSummary.from_json(value))
+        return summary, False
+
+    def summarize_output(self, u_id, output_name, chunksize=10000):
+        """Summary of a finished output without one (made before summaries were
+        kept), counted from the file once and stored; None if the output is gone."""
+        path = os.path.join(self.output_folder, output_name)
+        if not os.path.isfile(path):
+            return None
+        summary = ResultSummary()
+        for chunk in pd.read_csv(path, chunksize=chunksize, dtype=str, keep_default_na=False):
+            summary.add(chunk.to_dict("list"))
+        self.save_summary(u_id, summary)
+        return summary
+
+    def delete_checkpoint(self, task_id):
+        self.db_service.delete_checkpoint(task_id)
+
+    def get_status_info(self, u_id):
+        """(original_id, state, hash, filename, output_name) for an upload, or None if unknown.
+
+        Uploads in a terminal state are served from a short-lived in-process
+        cache, since status polling is by far the most frequent request.
+        """
+        now = time.monotonic()
+        cached = self._status_cache.get(u_id)
+        if cached and cached[0] > now:
+            return cached[1]
+        info = self.db_service.get_status_info(u_id)
+        if info and info[1] in self.TERMINAL_STATES and self.status_cache_ttl > 0:
+            if len(self._status_cache) >= 10000:
+                self._status_cache = {
+                    k: v for k, v in self._status_cache.items() if v[0] > now
+                }
+            self._status_cache[u_id] = (now + self.status_cache_ttl, info)
+        return info
+
     def get_original_id(self, uid):
-        hash_value = self.db_service.get_file_hash(uid)
-        return self.db_service.get_file_id(hash_value)
+        info = self.db_service.get_status_info(uid)
+        return info[0] if info else None
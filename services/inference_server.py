@@ -0,0 +1,281 @@
+"""Long-lived inference process behind POST /api/classify.
+
+Run it next to the API with `python -m services.inference_server`. API
+threads talk to it over multiprocessing connections; concurrent requests are
+coalesced into one model call per micro-batch.
+"""
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+
+from .classification import lookup_cached
+from .prediction_cache import normalize_comment
+from utils.config import Config
+
+logger = logging.getLogger(__name__)
+
+# the example value once shipped as the default
+PLACEHOLDER_AUTHKEYS = (b"", b"change-me")
+
+
+def require_authkey(authkey):
+    """Refuse an unset or placeholder key: the connections exchange pickles,
+    so whoever passes the handshake can run code on the other side."""
+    if not authkey or authkey in PLACEHOLDER_AUTHKEYS:
+        raise AuthenticationError(
+            "INFERENCE_SERVER_AUTHKEY is not set to a secret; refusing to use the inference server"
+        )
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+class LatencyStats:
+    """Percentiles over the last `size` samples, in ms."""
+
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds * 1000)
+            self.count += 1
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+        if not samples:
+            return {"count": count, "p50_ms": None, "p99_ms": None, "max_ms": None}
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 2)
+
+        return {
+            "count": count,
+            "p50_ms": percentile(0.50),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(samples[-1], 2),
+        }
+
+
+class _Request:
+    def __init__(self, texts, types):
+        self.texts = texts
+        self.types = types
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.labels = None
+        self.error = None
+
+
+class InferenceServer:
+    """Serves classify requests from many connections with micro-batching.
+
+    A request waits at most `max_wait_ms` for others to join its batch, and a
+    batch closes early once it holds `max_batch_size` comments. Requests for
+    the same types share one predict_batch call. `get_model()` is called for
+    every batch, so a redeployed model is picked up between batches; comments
+    found in `cache` (a PredictionCache) are not run through the model.
+    """
+
+    def __init__(
+        self,
+        get_model,
+        address,
+        authkey,
+        cache=None,
+        max_tokens=8192,
+        max_batch_size=64,
+        max_wait_ms=5,
+    ):
+        self.get_model = get_model
+        self.address = address
+        self.authkey = authkey
+        self.cache = cache
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.latency = LatencyStats()
+        self.batch_sizes = collections.deque(maxlen=1000)
+
+    def serve_forever(self):
+        require_authkey(self.authkey)
+        threading.Thread(target=self._batch_loop, name="microbatcher", daemon=True).start()
+        # the handshake runs on the connection's own thread (see _handle), so a
+        # burst of new clients or a stalled one never holds up accept()
+        with Listener(self.address, backlog=128) as listener:
+            logger.info("inference server listening on %s:%d", *self.address)
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                # what Listener(authkey=...) would do inside accept()
+                deliver_challenge(conn, self.authkey)
+                answer_challenge(conn, self.authkey)
+            except (AuthenticationError, EOFError, OSError) as e:
+                logger.warning("rejected connection: %s", e)
+                return
+            while True:
+                try:
+                    command, *args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if command == "stats":
+                    conn.send(("ok", self.stats()))
+                    continue
+                request = _Request(*args)
+                self.requests.put(request)
+                request.done.wait()
+                if request.error:
+                    conn.send(("error", request.error))
+                else:
+                    conn.send(("ok", request.labels))
+                self.latency.add(time.perf_counter() - request.received)
+
+    def _batch_loop(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0].texts)
+            deadline = batch[0].received + self.max_wait
+            while size < self.max_batch_size:
+                # past the deadline this still takes whatever queued up while
+                # the previous batch ran
+                timeout = max(0.0, deadline - time.perf_counter())
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self.batch_sizes.append(size)
+            self._run(batch)
+
+    def _run(self, batch):
+        batch.sort(key=lambda request: request.types)
+        try:
+            model = self.get_model()
+        except Exception:
+            logger.exception("no model to serve")
+            model = None
+        for types, requests in itertools.groupby(batch, key=lambda request: request.types):
+            requests = list(requests)
+            texts = [normalize_comment(text) for request in requests for text in request.texts]
+            try:
+                if model is None:
+                    raise RuntimeError("model is not available")
+                labels = self._predict(model, types, texts)
+            except Exception as e:
+                logger.exception("micro-batch failed")
+                for request in requests:
+                    request.error = str(e)
+                    request.done.set()
+                continue
+            offset = 0
+            for request in requests:
+                request.labels = labels[offset : offset + len(request.texts)]
+                offset += len(request.texts)
+                request.done.set()
+
+    def _predict(self, model, types, texts):
+        """One tuple of labels (in the order of `types`) per normalized text."""
+        if self.cache is None:
+            return model.heads_for(types).predict_batch(texts, max_tokens=self.max_tokens)
+        # the cache keeps every prediction's confidence, for the results' summaries
+        heads = model.heads_for(types, confidence=True)
+        keys, labels, missing = lookup_cached(self.cache, model.fingerprints, texts, types)
+        if missing:
+            predicted = heads.predict_batch(list(missing.values()), max_tokens=self.max_tokens)
+            new_labels = {
+                key: label
+                for row, row_labels in zip(missing, predicted)
+                for key, label in zip(row, row_labels)
+            }
+            self.cache.put_many(new_labels.items())
+            labels.update(new_labels)
+        return [tuple(labels[key][0] for key in row) for row in keys]
+
+    def stats(self):
+        sizes = list(self.batch_sizes)
+        return {
+            "latency": self.latency.summary(),
+            "batches": len(sizes),
+            "mean_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else None,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class InferenceClient:
+    """Client side of InferenceServer, with one connection per calling thread."""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+
+    def _call(self, *message):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            require_authkey(self.authkey)
+            conn = self.local.conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send(message)
+            status, result = conn.recv()
+        except (EOFError, OSError):
+            # server restarted: reconnect on the next call
+            self.local.conn = None
+            conn.close()
+            raise ConnectionError("inference server connection lost")
+        if status == "error":
+            raise RuntimeError(result)
+        return result
+
+    def classify(self, texts, types=("sentiment",)):
+        """One tuple of labels per text, in the order of `types`."""
+        return self._call("classify", list(texts), tuple(types))
+
+    def stats(self):
+        return self._call("stats")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    # same model (and heads) and prediction cache as the Celery workers
+    from .classification import registry
+    from .prediction_cache import PredictionCache
+
+    def current_model():
+        # a redeployed MODEL_PATH is picked up between batches (see ModelRegistry.refresh)
+        if Config.MODEL_SWAP_CHECK_INTERVAL > 0:
+            registry.refresh("sentiment", Config.MODEL_SWAP_CHECK_INTERVAL)
+        return registry.get("sentiment")
+
+    current_model()
+    server = InferenceServer(
+        current_model,
+        parse_address(Config.INFERENCE_SERVER_ADDRESS),
+        Config.INFERENCE_SERVER_AUTHKEY.encode(),
+        cache=PredictionCache(Config.PREDICTION_CACHE_DB, Config.PREDICTION_CACHE_MAX_ENTRIES),
+        max_tokens=Config.BATCH_TOKEN_BUDGET,
+        max_batch_size=Config.MICROBATCH_MAX_SIZE,
+        max_wait_ms=Config.MICROBATCH_MAX_WAIT_MS,
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+from utils.config import Config
+
+# cost classes of classification jobs, each with its own Celery queue
+JOB_CLASSES = ("small", "medium", "large")
+# maintenance tasks
+DEFAULT_QUEUE = "celery"
+
+
+def queue_name(job_class):
+    return f"classification.{job_class}"
+
+
+def job_class(rows, size):
+    """Cost class of a file of about `rows` comments in `size` bytes."""
+    if rows > Config.LARGE_JOB_ROWS or size > Config.LARGE_JOB_BYTES:
+        return "large"
+    if rows <= Config.SMALL_JOB_ROWS and size <= Config.SMALL_JOB_BYTES:
+        return "small"
+    return "medium"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p * len(values)))]
@@ -0,0 +1,98 @@
+import gzip
+import importlib.util
+import shutil
+import pandas as pd
+
+# rows converted per step, so a large output never has to fit in memory
+CONVERT_CHUNK_ROWS = 100000
+
+
+def _gzip(src, dst):
+    with open(src, "rb") as f, gzip.open(dst, "wb", compresslevel=6) as out:
+        shutil.copyfileobj(f, out, 1024 * 1024)
+
+
+def _zstd(src, dst):
+    import zstandard
+
+    with open(src, "rb") as f, open(dst, "wb") as out:
+        zstandard.ZstdCompressor(level=10, threads=-1).copy_stream(f, out)
+
+
+def _record_batches(src):
+    import pyarrow as pa
+
+    # every column as text: a chunk of numeric-looking comments must not
+    # change the schema halfway through
+    for chunk in pd.read_csv(src, dtype=str, keep_default_na=False, chunksize=CONVERT_CHUNK_ROWS):
+        yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+
+def _parquet(src, dst):
+    import pyarrow.parquet as pq
+
+    writer = None
+    for batch in _record_batches(src):
+        if writer is None:
+            writer = pq.ParquetWriter(dst, batch.schema, compression="zstd")
+        writer.write_batch(batch)
+    if writer:
+        writer.close()
+
+
+def _arrow(src, dst):
+    import pyarrow as pa
+
+    writer = None
+    with pa.OSFile(dst, "wb") as sink:
+        for batch in _record_batches(src):
+            if writer is None:
+                writer = pa.ipc.new_file(sink, batch.schema)
+            writer.write_batch(batch)
+        if writer:
+            writer.close()
+
+
+# name -> suffix of the cached artifact, media type, Content-Encoding when it
+# is served as compressed csv, converter (None for the output itself), and
+# the module it needs
+FORMATS = {
+    "csv": {"suffix": "", "mimetype": "text/csv", "encoding": None, "convert": None, "needs": None},
+    "csv.gz": {
+        "suffix": ".csv.gz",
+        "mimetype": "application/gzip",
+        "encoding": "gzip",
+        "convert": _gzip,
+        "needs": None,
+    },
+    "csv.zst": {
+        "suffix": ".csv.zst",
+        "mimetype": "application/zstd",
+        "encoding": "zstd",
+        "convert": _zstd,
+        "needs": "zstandard",
+    },
+    "parquet": {
+        "suffix": ".parquet",
+        "mimetype": "application/vnd.apache.parquet",
+        "encoding": None,
+        "convert": _parquet,
+        "needs": "pyarrow",
+    },
+    "arrow": {
+        "suffix": ".arrow",
+        "mimetype": "application/vnd.apache.arrow.file",
+        "encoding": None,
+        "convert": _arrow,
+        "needs": "pyarrow",
+    },
+}
+
+
+def available_formats():
+    """Formats whose optional dependency (pyarrow, zstandard) is installed."""
+    return [
+        name
+        for name, fmt in FORMATS.items()
+        if not fmt["needs"] or importlib.util.find_spec(fmt["needs"]) is not None
+    ]
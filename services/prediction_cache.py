@@ -0,0 +1,149 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+def normalize_comment(text):
+    """Canonical form of a comment; whitespace runs are irrelevant to the tokenizer."""
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+
+class PredictionCache:
+    """Comment-level prediction cache shared by every task on this machine.
+
+    Entries are keyed by (normalized comment, model fingerprint, classification
+    type), hold a (label, confidence) prediction and are evicted
+    least-recently-used once there are more than `max_entries` of them.
+    Counting the entries scans the whole table, so each process only does
+    that after every `max_entries / 100` (at most 10000) entries it stored;
+    the cache may briefly exceed its cap by that much per process.
+    """
+
+    # sqlite's default limit on bound parameters is 999
+    QUERY_CHUNK = 500
+
+    def __init__(self, db_file="prediction_cache.db", max_entries=1_000_000):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.evict_every = min(10_000, max(1, max_entries // 100))
+        self._stored = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=5, check_same_thread=False)
+        self._init_db()
+
+    def _init_db(self):
+        with self.lock:
+            # every worker process shares this file
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS predictions (
+                    key BLOB PRIMARY KEY,
+                    label TEXT,
+                    last_access REAL,
+                    confidence REAL
+                );
+                CREATE INDEX IF NOT EXISTS predictions_last_access
+                    ON predictions(last_access);
+
+                CREATE TABLE IF NOT EXISTS stats (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    hits INTEGER NOT NULL,
+                    misses INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO stats (id, hits, misses) VALUES (1, 0, 0);
+                """
+            )
+            self.conn.commit()
+            # caches from before confidences were kept; their entries count as misses
+            self.conn.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(predictions)")]
+            if "confidence" not in columns:
+                self.conn.execute("ALTER TABLE predictions ADD COLUMN confidence REAL")
+            self.conn.commit()
+
+    @staticmethod
+    def make_key(text, fingerprint, classification_type):
+        value = f"{fingerprint}\0{classification_type}\0{normalize_comment(text)}"
+        return hashlib.sha256(value.encode()).digest()
+
+    def get_many(self, keys, track_stats=True):
+        """Return {key: (label, confidence)} for the keys that are cached, and mark
+        them as used. Without `track_stats`, e.g. when looking keys up again
+        that were already counted, the hit/miss stats are left alone."""
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(keys), self.QUERY_CHUNK):
+                chunk = keys[i : i + self.QUERY_CHUNK]
+                cursor = self.conn.execute(
+                    """
+                    SELECT key, label, confidence FROM predictions
+                    WHERE key IN (%s) AND confidence IS NOT NULL
+                    """
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                found.update((key, (label, confidence)) for key, label, confidence in cursor)
+            self.conn.executemany(
+                "UPDATE predictions SET last_access = ? WHERE key = ?",
+                ((now, key) for key in found),
+            )
+            if track_stats:
+                self.conn.execute(
+                    "UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE id = 1",
+                    (len(found), len(keys) - len(found)),
+                )
+            self.conn.commit()
+        return found
+
+    def put_many(self, items):
+        """Store (key, (label, confidence)) pairs, evicting the least recently used
+        entries over the cap now and then."""
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.executemany(
+                """
+                INSERT OR REPLACE INTO predictions (key, label, last_access, confidence)
+                VALUES (?, ?, ?, ?)
+                """,
+                ((key, str(label), now, float(confidence)) for key, (label, confidence) in items),
+            )
+            self._stored += cursor.rowcount
+            if self._stored < self.evict_every:
+                self.conn.commit()
+                return
+            self._stored = 0
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()
+            if count > self.max_entries:
+                self.conn.execute(
+                    """
+                    DELETE FROM predictions WHERE key IN (
+                        SELECT key FROM predictions ORDER BY last_access LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,),
+                )
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()
+            hits, misses = self.conn.execute(
+                "SELECT hits, misses FROM stats WHERE id = 1"
+            ).fetchone()
+        lookups = hits + misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.conn.close()
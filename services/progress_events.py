@@ -0,0 +1,88 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressEvents:
+    """Task progress fan-out over Redis pub/sub.
+
+    Workers `publish` events for a task id. Each API process runs a single
+    subscriber thread on the channel and hands events to the local listeners
+    registered through `subscribe`, so connected clients never poll Redis
+    themselves. Publishing is best effort: progress events must never fail a
+    task.
+    """
+
+    def __init__(self, redis_url, channel="task-progress", listener_queue_size=64):
+        self.redis_url = redis_url
+        self.channel = channel
+        self.listener_queue_size = listener_queue_size
+        self.enabled = redis_url.startswith(("redis://", "rediss://", "unix://"))
+        self._redis = None
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _client(self):
+        if self._redis is None:
+            import redis
+
+            self._redis = redis.Redis.from_url(self.redis_url)
+        return self._redis
+
+    def publish(self, task_id, event):
+        if not self.enabled:
+            return
+        try:
+            self._client().publish(self.channel, json.dumps({"task_id": task_id, **event}))
+        except Exception as e:
+            logger.warning(f"could not publish progress of {task_id}: {e}")
+
+    def subscribe(self, task_id):
+        """Register a listener for `task_id` and return the queue its events arrive on."""
+        events = queue.Queue(maxsize=self.listener_queue_size)
+        with self._lock:
+            self._listeners.setdefault(task_id, set()).add(events)
+            if self.enabled and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(
+                    target=self._run, name="progress-events", daemon=True
+                )
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, task_id, events):
+        with self._lock:
+            listeners = self._listeners.get(task_id)
+            if listeners:
+                listeners.discard(events)
+                if not listeners:
+                    del self._listeners[task_id]
+
+    def _dispatch(self, event):
+        with self._lock:
+            targets = list(self._listeners.get(event.get("task_id"), ()))
+        for events in targets:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # slow client: drop its oldest event, the newest one matters most
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+                events.put_nowait(event)
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._dispatch(json.loads(message["data"]))
+            except Exception as e:
+                logger.warning(f"progress subscriber lost its connection: {e}")
+                time.sleep(1)
@@ -0,0 +1,102 @@
+import collections
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+_HASH_PREFIX = re.compile(r"^[0-9a-f]{64}")
+
+
+class StorageManager:
+    """Keeps uploads/ and outputs/ under a disk quota.
+
+    Every file belonging to a content hash (the upload, its outputs and the
+    converted downloads) is evicted together, least recently used first;
+    hashes no upload references any more go before all others. Eviction
+    starts above `quota_bytes` and stops once usage is under
+    `low_watermark * quota_bytes`. Hashes with a task in flight, or accessed
+    in the last `min_age` seconds, are never evicted. A quota of 0 disables
+    eviction.
+    """
+
+    def __init__(self, file_service, quota_bytes, low_watermark=0.9, min_age=3600):
+        self.file_service = file_service
+        self.db_service = file_service.db_service
+        self.quota_bytes = quota_bytes
+        self.low_watermark = low_watermark
+        self.min_age = min_age
+
+    def _disk_usage(self):
+        """(bytes per hash, newest mtime per hash, bytes not belonging to a hash)."""
+        by_hash = collections.Counter()
+        modified = {}
+        other = 0
+        for folder in (self.file_service.upload_folder, self.file_service.output_folder):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    match = _HASH_PREFIX.match(entry.name)
+                    if match:
+                        by_hash[match.group()] += stat.st_size
+                        modified[match.group()] = max(modified.get(match.group(), 0), stat.st_mtime)
+                    else:
+                        # upload sessions and temporary files
+                        other += stat.st_size
+        return by_hash, modified, other
+
+    def usage(self):
+        by_hash, _, other = self._disk_usage()
+        hashes = self.db_service.get_hash_usage()
+        total = sum(by_hash.values()) + other
+        return {
+            "total_bytes": total,
+            "quota_bytes": self.quota_bytes,
+            "used_fraction": round(total / self.quota_bytes, 4) if self.quota_bytes else None,
+            "hash_bytes": sum(by_hash.values()),
+            "other_bytes": other,
+            "hashes": len(hashes),
+            "unreferenced_hashes": sum(1 for _, refs, _, _ in hashes if refs <= 0),
+            "in_flight_hashes": sum(1 for _, _, _, busy in hashes if busy),
+            "oldest_access": hashes[0][2] if hashes else None,
+        }
+
+    def evict(self):
+        """Evict until under the low watermark; returns the evicted hashes."""
+        if not self.quota_bytes:
+            return []
+        by_hash, modified, other = self._disk_usage()
+        total = sum(by_hash.values()) + other
+        if total <= self.quota_bytes:
+            return []
+        target = self.quota_bytes * self.low_watermark
+        accessed_before = time.time() - self.min_age
+        candidates = [
+            (refs > 0, last_access, hash_value)
+            for hash_value, refs, last_access, busy in self.db_service.get_hash_usage()
+            if not busy and last_access < accessed_before
+        ]
+        evicted = []
+        for _, _, hash_value in sorted(candidates):
+            if total <= target:
+                break
+            # re-checked in the same transaction that forgets the hash
+            if not self.db_service.delete_hash(hash_value, accessed_before):
+                continue
+            self.file_service.delete_file(hash_value)
+            total -= by_hash.pop(hash_value, 0)
+            evicted.append(hash_value)
+        # files of hashes the database no longer knows about (an upload being
+        # registered right now is younger than min_age)
+        known = {hash_value for hash_value, _, _, _ in self.db_service.get_hash_usage()}
+        for hash_value in sorted(set(by_hash) - known, key=modified.get):
+            if total <= target or modified[hash_value] >= accessed_before:
+                break
+            self.file_service.delete_file(hash_value)
+            total -= by_hash.pop(hash_value)
+            evicted.append(hash_value)
+        logger.info("evicted %d hashes, %d bytes in use", len(evicted), total)
+        return evicted
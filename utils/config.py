@@ -6,8 +6,90 @@ class Config:
     DEBUG = os.getenv("DEBUG").lower() == "true"
     MODEL_PATH = os.getenv("MODEL_PATH", "data/fine_tuned_model")
     LABEL_PATH = os.getenv("LABEL_PATH", "data/label_encoder.pkl")
+    # inference backend: "eager" (fp32 pytorch), "int8" (dynamic quantization) or "onnx"
+    INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+    SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", INFERENCE_BACKEND)
+    # quantized / exported encoders are cached here, next to the model by default
+    BACKEND_CACHE_DIR = os.getenv("BACKEND_CACHE_DIR", os.path.dirname(os.path.abspath(MODEL_PATH)))
+    # load the weights in the main celery worker process before it forks its
+    # pool, so children share them (eager and int8 backends on CPU)
+    PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "true").lower() == "true"
+    # seconds between checks at task start for a redeployed MODEL_PATH (0: never)
+    MODEL_SWAP_CHECK_INTERVAL = float(os.getenv("MODEL_SWAP_CHECK_INTERVAL", 10))
+    # optional main/sub theme heads on the sentiment encoder, and the Excel
+    # file naming their themes; without them only "sentiment" is available
+    THEME_HEADS_PATH = os.getenv("THEME_HEADS_PATH", "")
+    THEME_MAPPING_PATH = os.getenv("THEME_MAPPING_PATH", "data/themes.xlsx")
     UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "uploads")
     OUTPUT_FOLDER = os.getenv("OUTPUT_FOLDER", "outputs")
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", 16 * 1024 * 1024))
+    # resumable uploads: MAX_CONTENT_LENGTH caps each chunk, not the file
+    UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+    MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024**3))
+    # seconds an unfinished upload is kept after its last chunk
+    UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+    # rows read, classified and written per step; bounds worker memory
+    CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", 10000))
+    # upper bound on padded tokens (rows * longest row) per inference batch
+    BATCH_TOKEN_BUDGET = int(os.getenv("BATCH_TOKEN_BUDGET", 8192))
+    # task progress is published when either threshold is reached
+    PROGRESS_EVERY_ROWS = int(os.getenv("PROGRESS_EVERY_ROWS", 1000))
+    PROGRESS_EVERY_MS = int(os.getenv("PROGRESS_EVERY_MS", 1000))
+    # seconds a finished upload's status is cached by the api process
+    STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", 30))
+    # padded batches tokenized ahead of the model
+    PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", 4))
+    # files with more rows than this are split into SHARD_ROWS-row shards
+    # that run as separate tasks, then merged
+    SHARD_THRESHOLD_ROWS = int(os.getenv("SHARD_THRESHOLD_ROWS", 200000))
+    SHARD_ROWS = int(os.getenv("SHARD_ROWS", 50000))
+    # uploads + outputs are kept under this many bytes (0: no limit) by evicting
+    # least recently used files down to STORAGE_LOW_WATERMARK of it, every
+    # STORAGE_CHECK_INTERVAL seconds; files used in the last STORAGE_MIN_AGE
+    # seconds are kept
+    STORAGE_QUOTA_BYTES = int(os.getenv("STORAGE_QUOTA_BYTES", 0))
+    STORAGE_LOW_WATERMARK = float(os.getenv("STORAGE_LOW_WATERMARK", 0.9))
+    STORAGE_CHECK_INTERVAL = int(os.getenv("STORAGE_CHECK_INTERVAL", 300))
+    STORAGE_MIN_AGE = int(os.getenv("STORAGE_MIN_AGE", 3600))
+    PREDICTION_CACHE_DB = os.getenv("PREDICTION_CACHE_DB", "prediction_cache.db")
+    PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv("PREDICTION_CACHE_MAX_ENTRIES", 1_000_000))
+    # synchronous /api/classify: inference server address, and its micro-batching
+    INFERENCE_SERVER_ADDRESS = os.getenv("INFERENCE_SERVER_ADDRESS", "localhost:6390")
+    # required by the inference server and its clients; no default on purpose
+    INFERENCE_SERVER_AUTHKEY = os.getenv("INFERENCE_SERVER_AUTHKEY", "")
+    MICROBATCH_MAX_SIZE = int(os.getenv("MICROBATCH_MAX_SIZE", 64))
+    MICROBATCH_MAX_WAIT_MS = float(os.getenv("MICROBATCH_MAX_WAIT_MS", 5))
+    CLASSIFY_MAX_COMMENTS = int(os.getenv("CLASSIFY_MAX_COMMENTS", 64))
+    # cost classes of uploads (see services.job_queues): small if at most
+    # SMALL_JOB_ROWS rows and SMALL_JOB_BYTES, large above LARGE_JOB_ROWS or
+    # LARGE_JOB_BYTES, medium otherwise; each class has its own queue
+    SMALL_JOB_ROWS = int(os.getenv("SMALL_JOB_ROWS", 1000))
+    SMALL_JOB_BYTES = int(os.getenv("SMALL_JOB_BYTES", 1024 * 1024))
+    LARGE_JOB_ROWS = int(os.getenv("LARGE_JOB_ROWS", 50000))
+    LARGE_JOB_BYTES = int(os.getenv("LARGE_JOB_BYTES", 50 * 1024 * 1024))
+    # large jobs a client may have processing at once (0: no limit); further
+    # ones are retried every HEAVY_JOB_RETRY_SECONDS
+    MAX_HEAVY_JOBS_PER_CLIENT = int(os.getenv("MAX_HEAVY_JOBS_PER_CLIENT", 2))
+    HEAVY_JOB_RETRY_SECONDS = int(os.getenv("HEAVY_JOB_RETRY_SECONDS", 30))
+    # reverse proxies in front of the API whose X-Forwarded-For is trusted
+    # (0: clients connect directly and the header is ignored)
+    TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))
+    # seconds of started jobs that /api/stats/queues reports queue waits over
+    QUEUE_STATS_WINDOW = int(os.getenv("QUEUE_STATS_WINDOW", 3600))
+    # tasks a worker process reserves ahead; 1 keeps a long task from holding
+    # back short ones queued behind it
+    CELERY_PREFETCH_MULTIPLIER = int(os.getenv("CELERY_PREFETCH_MULTIPLIER", 1))
+    # fraction of classification tasks run under the profiler (see utils.profiling)
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    # inference batches recorded in a profile's torch trace
+    PROFILE_TRACE_BATCHES = int(os.getenv("PROFILE_TRACE_BATCHES", 20))
+    # port of the worker's prometheus exporter (0: off); the api serves /metrics
+    WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9101))
     CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
-    CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
\ No newline at end of file
+    CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+    # redis pub/sub used to push task progress to connected clients
+    PROGRESS_EVENTS_URL = os.getenv("PROGRESS_EVENTS_URL", CELERY_BROKER_URL)
+    PROGRESS_EVENTS_CHANNEL = os.getenv("PROGRESS_EVENTS_CHANNEL", "task-progress")
+    SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+    LONG_POLL_MAX_WAIT = float(os.getenv("LONG_POLL_MAX_WAIT", 30))
+    CELERY_VISIBILITY_TIMEOUT = int(os.getenv("CELERY_VISIBILITY_TIMEOUT", 6 * 60 * 60))
\ No newline at end of file
@@ -0,0 +1,76 @@
+import hashlib
+import os
+
+# (path, size, mtime) -> digest, so unchanged files are only hashed once per process
+_file_digests = {}
+
+
+def _file_digest(path):
+    stat = os.stat(path)
+    # resolved, so repointing a symlink to a copy with the same size and mtime still counts
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _file_digests.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        _file_digests[key] = digest
+    return digest
+
+
+def model_fingerprint(model_path, label_path=None, extra=()):
+    """Content hash of a model directory and its label encoder (if any).
+
+    Two deployments of the same weights get the same fingerprint, and any
+    change to the weights, config, vocab or labels gives a new one. `extra`
+    values (e.g. the inference backend) are mixed in as well.
+    """
+    h = hashlib.sha256()
+    paths = []
+    if os.path.isdir(model_path):
+        for root, _, files in os.walk(model_path):
+            paths.extend(os.path.join(root, name) for name in files)
+    else:
+        paths.append(model_path)
+    if label_path:
+        paths.append(label_path)
+    for path in sorted(paths):
+        name = os.path.relpath(path, model_path) if path != label_path else "labels"
+        h.update(f"{name}\0{_file_digest(path)}\0".encode())
+    for value in extra:
+        h.update(f"{value}\0".encode())
+    return h.hexdigest()
+
+
+def combined_fingerprint(fingerprints):
+    """One fingerprint for a model's {classification type: fingerprint}, so a
+    whole output can be keyed by the model that produced it."""
+    h = hashlib.sha256()
+    for name in sorted(fingerprints):
+        h.update(f"{name}\0{fingerprints[name]}\0".encode())
+    return h.hexdigest()
+
+
+def file_version(paths):
+    """Cheap stand-in for model_fingerprint: where `paths` resolve to and the
+    size and mtime of every file under them. Any redeploy changes it,
+    including repointing a symlink."""
+    version = []
+    for top in paths:
+        files = [top]
+        if os.path.isdir(top):
+            files = sorted(
+                os.path.join(root, name) for root, _, names in os.walk(top) for name in names
+            )
+        version.append(os.path.realpath(top))
+        for path in files:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # being replaced right now
+                version.append((path, None))
+                continue
+            version.append((path, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha256(repr(version).encode()).hexdigest()[:16]
@@ -2,9 +2,10 @@
 import hashlib
 
 class HashingFile:
-    def __init__(self, file):
+    def __init__(self, file, hash=None):
         self.file = file
-        self.hash = hashlib.sha256()
+        # pass a hash object to continue hashing a partly written file
+        self.hash = hash or hashlib.sha256()
         
     def write(self, data):
         self.hash.update(data)
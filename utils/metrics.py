@@ -0,0 +1,156 @@
+"""Prometheus metrics of the api and the workers.
+
+With several processes (gunicorn workers, celery prefork children) set
+PROMETHEUS_MULTIPROC_DIR to an empty directory before start; each process
+then writes its samples there and `render()` aggregates them.
+"""
+import functools
+import os
+import time
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# per chunk of CSV_CHUNK_ROWS rows, so the batch loop itself is never instrumented
+STAGE_SECONDS = Histogram(
+    "classification_stage_seconds",
+    "Seconds spent per chunk in each stage of classification_task",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+ROWS = Counter("classification_rows_total", "Rows classified")
+ROWS_PER_SECOND = Gauge(
+    "classification_rows_per_second",
+    "Throughput of the running tasks, summed over worker processes",
+    multiprocess_mode="livesum",
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "classification_queue_wait_seconds",
+    "Seconds from upload until the classification task started, per job class",
+    ["job_class"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+HEAVY_JOBS_DEFERRED = Counter(
+    "classification_heavy_jobs_deferred_total",
+    "Large jobs retried later because their client was at its limit",
+)
+MODEL_LOAD_SECONDS = Gauge(
+    "model_load_seconds", "Seconds to load a model", ["model", "phase"], multiprocess_mode="max"
+)
+MODEL_SWAPS = Counter("model_swaps_total", "Models reloaded because MODEL_PATH changed")
+WORKER_MEMORY_BYTES = Gauge(
+    "worker_memory_bytes",
+    "Memory of a worker process once its models are loaded: rss, pss and private",
+    ["kind"],
+    multiprocess_mode="all",
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds",
+    "Latency of DBService methods",
+    ["method"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1),
+)
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes received by uploads")
+UPLOAD_BYTES_PER_SECOND = Histogram(
+    "upload_bytes_per_second",
+    "Receive rate of each upload (or upload chunk)",
+    buckets=(1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9),
+)
+
+
+def timed_db_query(fn):
+    """Record a DBService method's latency under its name."""
+    histogram = DB_QUERY_SECONDS.labels(fn.__name__)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def observe_upload(size, seconds):
+    UPLOAD_BYTES.inc(size)
+    if seconds > 0:
+        UPLOAD_BYTES_PER_SECOND.observe(size / seconds)
+
+
+class StageTimer:
+    """Turns InferencePipeline's running stage totals into per-chunk observations."""
+
+    STAGES = ("read", "tokenize", "inference", "decode")
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.last = dict.fromkeys(self.STAGES, 0.0)
+
+    def chunk_done(self, rows, write_seconds):
+        for stage in self.STAGES:
+            total = self.stats.get(stage, 0.0)
+            STAGE_SECONDS.labels(stage).observe(total - self.last[stage])
+            self.last[stage] = total
+        STAGE_SECONDS.labels("write").observe(write_seconds)
+        ROWS.inc(rows)
+
+
+class QueueDepthCollector:
+    """Reads the broker's queue lengths at scrape time."""
+
+    def __init__(self, depths):
+        self.depths = depths
+
+    def collect(self):
+        gauge = GaugeMetricFamily("celery_queue_depth", "Messages waiting in a queue", labels=["queue"])
+        for queue, depth in self.depths().items():
+            gauge.add_metric([queue], depth)
+        yield gauge
+
+
+def _registry():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render(queue_depths=None):
+    """The exposition text of this process (or all processes, in multiprocess mode)."""
+    registry = _registry()
+    if queue_depths is not None:
+        if registry is REGISTRY:
+            # never register into the global registry for one scrape
+            registry = CollectorRegistry()
+            registry.register(_GlobalCollector())
+        registry.register(QueueDepthCollector(queue_depths))
+    return generate_latest(registry)
+
+
+class _GlobalCollector:
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def start_exporter(port):
+    """Serve the metrics of this process and its children on `port`."""
+    start_http_server(port, registry=_registry())
+
+
+def mark_process_dead(pid):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,136 @@
+"""Opt-in profiling of a classification task.
+
+A profiled task writes three files next to its output, keyed by the output
+name: `<output>.profile.json` (summary with the top hotspots),
+`<output>.pstats` (cProfile of the Python stages, for pstats/snakeviz) and
+`<output>.trace.json.gz` (torch profiler trace of the first inference
+batches, for chrome://tracing or Perfetto).
+"""
+import cProfile
+import gzip
+import io
+import json
+import os
+import pstats
+import shutil
+import time
+
+FILES = {
+    "summary": ".profile.json",
+    "pstats": ".pstats",
+    "trace": ".trace.json.gz",
+}
+
+
+class TaskProfiler:
+    """cProfile of the calling thread and the pipeline thread, plus a torch trace.
+
+    Use as a context manager around the work, hand `wrap` the pipeline's
+    thread target and call `step()` after every inference batch; the torch
+    profiler stops after `trace_batches` batches to keep the trace small.
+    """
+
+    def __init__(self, trace_batches=20, top=20):
+        self.trace_batches = trace_batches
+        self.top = top
+        self.profiles = []
+        self.torch_profile = None
+        self.recording = False
+        self.batches = 0
+        self.info = {}
+
+    def __enter__(self):
+        from torch.profiler import ProfilerActivity, profile
+
+        self.started = time.perf_counter()
+        # input shapes show how long the padded batches were
+        self.torch_profile = profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+        self.torch_profile.start()
+        self.recording = True
+        self.profiles.append(cProfile.Profile())
+        self.profiles[0].enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiles[0].disable()
+        self._stop_trace()
+        self.seconds = time.perf_counter() - self.started
+
+    def _stop_trace(self):
+        if self.recording:
+            self.torch_profile.stop()
+            self.recording = False
+
+    def step(self):
+        self.batches += 1
+        if self.batches >= self.trace_batches:
+            self._stop_trace()
+
+    def wrap(self, target):
+        """`target` profiled on whatever thread runs it."""
+
+        def run(*args, **kwargs):
+            profile = cProfile.Profile()
+            self.profiles.append(profile)
+            profile.enable()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profile.disable()
+
+        return run
+
+    def python_hotspots(self):
+        stats = pstats.Stats(*self.profiles, stream=io.StringIO())
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        return [
+            {
+                "function": f"{os.path.basename(file)}:{line}({name})",
+                "calls": calls,
+                "self_seconds": round(tottime, 4),
+                "cumulative_seconds": round(cumtime, 4),
+            }
+            for (file, line, name), (_, calls, tottime, cumtime, _) in rows[: self.top]
+        ]
+
+    def torch_hotspots(self):
+        events = sorted(
+            self.torch_profile.key_averages(group_by_input_shape=True),
+            key=lambda event: event.self_cpu_time_total,
+            reverse=True,
+        )
+        return [
+            {
+                "op": event.key,
+                "input_shapes": str(event.input_shapes),
+                "calls": event.count,
+                "self_cpu_ms": round(event.self_cpu_time_total / 1000, 3),
+                "cpu_total_ms": round(event.cpu_time_total / 1000, 3),
+            }
+            for event in events[: self.top]
+        ]
+
+    def save(self, base_path, **info):
+        """Write the summary, pstats and trace to `base_path` + FILES suffixes."""
+        stats = pstats.Stats(*self.profiles, stream=io.StringIO())
+        stats.dump_stats(base_path + FILES["pstats"])
+        trace = f"{base_path}.{os.getpid()}.trace.tmp"
+        try:
+            self.torch_profile.export_chrome_trace(trace)
+            with open(trace, "rb") as f, gzip.open(base_path + FILES["trace"], "wb") as out:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+        finally:
+            if os.path.exists(trace):
+                os.remove(trace)
+        summary = {
+            **self.info,
+            **info,
+            "created": time.time(),
+            "seconds": round(self.seconds, 3),
+            "traced_batches": min(self.batches, self.trace_batches),
+            "python_hotspots": self.python_hotspots(),
+            "torch_hotspots": self.torch_hotspots(),
+        }
+        with open(base_path + FILES["summary"], "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
@@ -0,0 +1,51 @@
+import time
+
+
+class ProgressReporter:
+    """Publishes a task's progress at most once per `every_rows` rows or `every_ms` ms.
+
+    Each publish is a result backend write, so reporting every row costs one
+    Redis round-trip per row. Whichever threshold is reached first triggers
+    the next publish. The meta carries throughput and an ETA next to
+    current/total. `on_update(meta)` is called after each publish.
+    """
+
+    def __init__(self, task, total, start=0, every_rows=1000, every_ms=1000, on_update=None):
+        self.task = task
+        self.on_update = on_update
+        self.total = total
+        self.every_rows = every_rows
+        self.every_ms = every_ms
+        self.start_rows = start
+        self.started = time.monotonic()
+        self.last_rows = None
+        self.last_time = None
+
+    def update(self, current, force=False):
+        """Publish `current` if a threshold has passed (or `force`); returns whether it did."""
+        now = time.monotonic()
+        if not force and self.last_rows is not None:
+            if (
+                current - self.last_rows < self.every_rows
+                and (now - self.last_time) * 1000 < self.every_ms
+            ):
+                return False
+        meta = self.meta(current, now)
+        self.task.update_state(state="PROCESSING", meta=meta)
+        if self.on_update:
+            self.on_update(meta)
+        self.last_rows = current
+        self.last_time = now
+        return True
+
+    def meta(self, current, now=None):
+        elapsed = (now or time.monotonic()) - self.started
+        # rows resumed from a checkpoint were not processed by this run
+        rate = (current - self.start_rows) / elapsed if elapsed > 0 else 0.0
+        return {
+            "current": current,
+            "total": self.total,
+            "elapsed": round(elapsed, 3),
+            "rows_per_sec": round(rate, 1),
+            "eta": round((self.total - current) / rate, 1) if rate > 0 else None,
+        }
@@ -0,0 +1,70 @@
+import collections
+import json
+
+
+class ResultSummary:
+    """Label counts and mean confidence per classification type over the rows
+    classified so far.
+
+    Updated chunk by chunk while a task writes its output and stored as JSON
+    with its checkpoints, so it always covers exactly the checkpointed rows
+    and a resumed task carries on from there. Summaries of shards add up.
+    """
+
+    def __init__(self, rows=0, counts=None, confidence=None):
+        self.rows = rows
+        self.counts = {
+            type: collections.Counter(labels) for type, labels in (counts or {}).items()
+        }
+        # type -> [sum, count] of the predictions' confidences; outputs and
+        # checkpoints from before these were kept have none
+        self.confidence = {type: list(total) for type, total in (confidence or {}).items()}
+
+    def add(self, classified_data, confidences=None):
+        """Count a chunk of output: {"comment": [...], type: [label, ...], ...},
+        with {type: [confidence, ...]} of its predictions if known."""
+        self.rows += len(classified_data["comment"])
+        for type, labels in classified_data.items():
+            if type != "comment":
+                self.counts.setdefault(type, collections.Counter()).update(map(str, labels))
+        for type, values in (confidences or {}).items():
+            total = self.confidence.setdefault(type, [0.0, 0])
+            total[0] += sum(values)
+            total[1] += len(values)
+
+    def merge(self, other):
+        self.rows += other.rows
+        for type, counts in other.counts.items():
+            self.counts.setdefault(type, collections.Counter()).update(counts)
+        for type, (value, count) in other.confidence.items():
+            total = self.confidence.setdefault(type, [0.0, 0])
+            total[0] += value
+            total[1] += count
+        return self
+
+    def to_json(self):
+        return json.dumps({"rows": self.rows, "counts": self.counts, "confidence": self.confidence})
+
+    @classmethod
+    def from_json(cls, value):
+        if not value:
+            return cls()
+        data = json.loads(value)
+        return cls(data["rows"], data["counts"], data.get("confidence"))
+
+    def as_dict(self):
+        """{rows, types: {type: {counts, shares, mean_confidence}}}, labels by
+        descending count; mean_confidence is None where no confidences are known."""
+        types = {}
+        for type, counts in self.counts.items():
+            ordered = counts.most_common()
+            value, count = self.confidence.get(type, (0.0, 0))
+            types[type] = {
+                "counts": dict(ordered),
+                "shares": {
+                    label: round(count / self.rows, 4) if self.rows else 0.0
+                    for label, count in ordered
+                },
+                "mean_confidence": round(value / count, 4) if count else None,
+            }
+        return {"rows": self.rows, "types": types}
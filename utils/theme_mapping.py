@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 class ThemeMapping:
@@ -9,9 +10,27 @@ class ThemeMapping:
         self.sub_id_to_name = {i: name for i, name in enumerate(self.sub_themes)}
         self.num_main = len(self.main_themes)
         self.num_sub = len(self.sub_themes)
+        # index n is 'Unknown', for ids out of range
+        self._main_names = np.array(self.main_themes + ['Unknown'], dtype=object)
+        self._sub_names = np.array(self.sub_themes + ['Unknown'], dtype=object)
 
     def get_main_name(self, id):
         return self.main_id_to_name.get(id, 'Unknown')
 
     def get_sub_name(self, id):
         return self.sub_id_to_name.get(id, 'Unknown')
+
+    def get_main_names(self, ids):
+        """get_main_name for a whole batch of ids at once."""
+        return self._lookup(self._main_names, ids)
+
+    def get_sub_names(self, ids):
+        """get_sub_name for a whole batch of ids at once."""
+        return self._lookup(self._sub_names, ids)
+
+    @staticmethod
+    def _lookup(names, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        unknown = len(names) - 1
+        ids = np.where((ids >= 0) & (ids < unknown), ids, unknown)
+        return names[ids].tolist()